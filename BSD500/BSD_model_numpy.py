@@ -0,0 +1,63 @@
+'''BSD model in NumPy, for inference without tensorflow'''
+
+import os
+import sys
+sys.path.append('../')
+
+import numpy as np
+
+import harmonic_network_numpy as hn_np
+
+
+def to_4d(x):
+    """Convert array to 4d"""
+    return np.reshape(x, x.shape[:3] + (-1,))
+
+
+def hnet_bsd(args, x, params):
+    """Forward pass of BSD_model.hnet_bsd in test mode, with the parameters
+    from harmonic_network_lite.export, see harmonic_network_numpy. Returns the
+    dict of side and fused predictions (logits).
+
+    args: settings, as for BSD_model.hnet_bsd
+    x: array of images, shape [batchsize,height,width,3]
+    params: dict from harmonic_network_numpy.load
+    """
+    xsh = x.shape
+    x = np.reshape(x, [xsh[0],xsh[1],xsh[2],1,1,3]).astype(np.float32)
+    fm = {}
+
+    def block(x, stage):
+        """conv -> nonlinearity -> conv -> batch norm"""
+        cv = hn_np.conv2d(x, params, padding='SAME', name=stage+'_1')
+        cv = hn_np.non_linearity(cv, params, name=stage+'_1')
+
+        cv = hn_np.conv2d(cv, params, padding='SAME', name=stage+'_2')
+        return hn_np.batch_norm(cv, params, name='bn'+stage)
+
+    # Convolutional Layers
+    cv = x
+    for stage in range(1, 6):
+        if stage > 1:
+            cv = hn_np.mean_pool(cv, ksize=(1,2,2,1), strides=(1,2,2,1))
+        cv = block(cv, str(stage))
+        mags = to_4d(hn_np.stack_magnitudes(cv))
+        fm[stage] = linear(mags, params, name='sw'+str(stage))
+
+    fms = {}
+    side_preds = []
+    for key in sorted(fm.keys()):
+        fms[key] = hn_np.resize_bilinear(fm[key], xsh[1:3])
+        side_preds.append(fms[key])
+    side_preds = np.concatenate(side_preds, axis=3)
+
+    fms['fuse'] = linear(side_preds, params, name='side_preds')
+    return fms
+
+
+def linear(x, params, strides=(1,1,1,1), padding='SAME', name=''):
+    """Basic linear layer, with a bias if the layer has one"""
+    z = hn_np.conv(x, params[name+'_W'], strides=strides, padding=padding)
+    if name+'_b' in params:
+        z = z + params[name+'_b']
+    return z
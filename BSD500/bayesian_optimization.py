@@ -45,6 +45,13 @@ def wrapper_function(dimension):
    parser.add_argument("--default_settings", help="use default settings", type=bool, default=False)
    parser.add_argument("--combine_train_val", help="combine the training and validation sets for testing", type=bool, default=False)
    parser.add_argument("--delete_existing", help="delete the existing auxilliary files", type=bool, default=True)
+   parser.add_argument("--algorithm", help="harmonic convolution algorithm {auto,direct,fft,basis,gauss}", default='auto')
+   parser.add_argument("--precision", help="precision of the harmonic layers {float32,float16}, in which their convolutions also accumulate", default='float32')
+   parser.add_argument("--real_order0", help="keep the order 0 filters of the first layer real, so the exported filter bank leaves out their zero imaginary response, which harmonic_network_numpy then skips (tensorflow still computes it)", type=bool, default=False)
+   parser.add_argument("--checkpoint_blocks", help="recompute the activations of each hnet block in the backward pass", type=bool, default=False)
+   parser.add_argument("--n_workers", help="number of processes augmenting the training batches, 0 to augment them synchronously", type=int, default=2)
+   parser.add_argument("--n_prefetch", help="number of augmented training batches kept ready, rounded down to a multiple of n_workers", type=int, default=4)
+   parser.add_argument("--seed", help="seed of the shuffling and augmentation of the training batches", type=int, default=0)
    args = parser.parse_args()
 
    # Default configuration
@@ -0,0 +1,187 @@
+'''Edge detection on images of any size with a trained hnet_bsd'''
+
+import argparse
+import os
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+import skimage.io as skio
+
+
+def receptive_field(args, n_stages=5):
+   """Return the radius in pixels of the receptive field of the outputs of
+   hnet_bsd: each stage adds two convolutions at its scale, the mean pooling
+   before it half a pixel of that scale, and the upsampling of the coarsest
+   side output one pixel of its scale"""
+   radius = 0
+   for stage in xrange(n_stages):
+      scale = 2**stage
+      if stage > 0:
+         radius += scale/2
+      radius += 2*(args.filter_size/2)*scale
+   return radius + 2**(n_stages-1)
+
+
+def tiled_predict(predict, image, tile_size, margin, out, batch_size=1,
+                  crop=False):
+   """Run predict on overlapping windows of an image and stitch the results.
+   Each window holds a tile of tile_size pixels and a halo of margin pixels
+   on all sides, which is trimmed from the prediction, so only one batch of
+   windows is in memory at a time. With a margin of at least the receptive
+   field, the tiles match a prediction on the whole image, except near the
+   image border, where the windows are zero filled unless they are cropped.
+
+   predict: function mapping a batch of windows, shape
+   [batch_size,tile_size+2*margin,tile_size+2*margin,channels], to
+   predictions of the same height and width
+   image: array shape [height,width,channels], e.g. memory-mapped
+   tile_size: size of the kept part of each window (int)
+   margin: size of the halo, a multiple of the total pooling stride so that
+   the pooling grids of all windows line up (int)
+   out: array shape [height,width] for the predictions, e.g. memory-mapped
+   batch_size: number of windows per call of predict (default 1)
+   crop: cut the windows off at the image border, so that they are padded
+   like the whole image. Only for predictors taking windows of any size, one
+   at a time, such as the numpy engine (default False)
+   """
+   height, width = image.shape[:2]
+   window = tile_size + 2*margin
+   origins = [(r, c) for r in xrange(0, height, tile_size)
+              for c in xrange(0, width, tile_size)]
+   if crop:
+      batch_size = 1
+   for start in xrange(0, len(origins), batch_size):
+      excerpt = origins[start:start+batch_size]
+      bounds = [(max(r-margin, 0), min(r+tile_size+margin, height),
+                 max(c-margin, 0), min(c+tile_size+margin, width))
+                for r, c in excerpt]
+      if crop:
+         r0, r1, c0, c1 = bounds[0]
+         X = np.asarray(image[np.newaxis,r0:r1,c0:c1], dtype=np.float32)
+      else:
+         # The window is zero outside of the image
+         X = np.zeros((batch_size, window, window, image.shape[2]), dtype=np.float32)
+         for i, ((r, c), (r0, r1, c0, c1)) in enumerate(zip(excerpt, bounds)):
+            X[i,r0-r+margin:r1-r+margin,c0-c+margin:c1-c+margin] = image[r0:r1,c0:c1]
+      Y = predict(X)
+      for i, ((r, c), (r0, r1, c0, c1)) in enumerate(zip(excerpt, bounds)):
+         # Offset of the tile in the window
+         dr, dc = (r-r0, c-c0) if crop else (margin, margin)
+         h = min(tile_size, height-r)
+         w = min(tile_size, width-c)
+         out[r:r+h,c:c+w] = np.reshape(Y[i], Y[i].shape[:2])[dr:dr+h,dc:dc+w]
+   return out
+
+
+def load_image(file_name):
+   """Load an image as float32 in [0,1]. Images saved as .npy are
+   memory-mapped instead of loaded."""
+   if file_name.endswith('.npy'):
+      return np.load(file_name, mmap_mode='r')
+   image = skio.imread(file_name)
+   if image.dtype == np.uint8:
+      image = image / 255.
+   return image.astype(np.float32)
+
+
+def tf_predictor(args, window):
+   """Return a function running hnet_bsd in tensorflow on batches of windows
+   of size window, restored from the checkpoint args.checkpoint. The filters
+   and batch norms of the trained model are frozen into constants, so the
+   inference graph holds no weights, phases or training ops."""
+   import tensorflow as tf
+   import BSD_model
+   import harmonic_network_lite as hl
+
+   # Evaluate the filters and folded batch norms in a throwaway graph, on
+   # full batches, so that conv2d is autotuned for them
+   with tf.Graph().as_default():
+      x = tf.placeholder(tf.float32, [args.batch_size,window,window,3], name='x')
+      train_phase = tf.placeholder(tf.bool, name='train_phase')
+      BSD_model.hnet_bsd(args, x, train_phase)
+      with tf.Session() as sess:
+         sess.run(tf.global_variables_initializer())
+         hl.restore_variables(sess, args.checkpoint)
+         params = hl.freeze(sess, feed_dict={train_phase: False})
+
+   # Rebuild the model from them, the last batch may be smaller
+   x = tf.placeholder(tf.float32, [None,window,window,3], name='x')
+   train_phase = tf.placeholder(tf.bool, name='train_phase')
+   with hl.frozen(params):
+      pred = BSD_model.hnet_bsd(args, x, train_phase)
+   bsd_map = tf.nn.sigmoid(pred['fuse'])
+   sess = tf.Session()
+   sess.run(tf.global_variables_initializer())
+   hl.restore_variables(sess, args.checkpoint)
+   def predict(X):
+      return sess.run(bsd_map, feed_dict={x: X, train_phase: False})
+   return predict
+
+
+def numpy_predictor(args):
+   """Return a function running hnet_bsd in NumPy on batches of windows, with
+   the parameters exported to args.checkpoint"""
+   import BSD_model_numpy
+   import harmonic_network_numpy as hn_np
+
+   params = hn_np.load(args.checkpoint)
+   def predict(X):
+      logits = BSD_model_numpy.hnet_bsd(args, X, params)['fuse']
+      return 1. / (1. + np.exp(-logits))
+   return predict
+
+
+def main(args):
+   """Predict the edge map of args.input into the .npy file args.output"""
+   # Default configuration, as in run_BSD.py
+   args.std_mult = 0.8
+   args.filter_gain = 2
+   args.filter_size = 5
+   args.n_rings = 4
+   args.n_filters = 7
+   args.n_channels = 3
+   args.checkpoint_blocks = False
+
+   # The windows overlap by the receptive field, and start on the grid of
+   # the coarsest stage, which is pooled 4 times
+   stride = 2**4
+   radius = receptive_field(args)
+   margin = -(-radius // stride)*stride
+   tile_size = -(-args.tile_size // stride)*stride
+   window = tile_size + 2*margin
+   if args.engine == 'tf':
+      predict = tf_predictor(args, window)
+   elif args.engine == 'numpy':
+      predict = numpy_predictor(args)
+   else:
+      print('Must execute script with valid --engine flag: "tf" or "numpy"')
+      sys.exit(-1)
+
+   image = load_image(args.input)
+   out = np.lib.format.open_memmap(args.output, mode='w+', dtype=np.float32,
+                                   shape=image.shape[:2])
+   start = time.time()
+   # The tf engine runs batches of zero filled windows of one size, the
+   # numpy engine one cropped window at a time
+   tiled_predict(predict, image, tile_size, margin, out,
+                 batch_size=args.batch_size, crop=(args.engine == 'numpy'))
+   out.flush()
+   print('Predicted {:d}x{:d} image in {:0.1f}s with {:d}x{:d} windows (halo {:d}), '
+         'saved to {:s}'.format(image.shape[0], image.shape[1], time.time()-start,
+         window, window, margin, args.output))
+
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--input", help="image file, or .npy array of shape [height,width,3] in [0,1]", required=True)
+   parser.add_argument("--output", help="output .npy file for the edge map", default='./edges.npy')
+   parser.add_argument("--engine", help="inference engine {tf,numpy}", default='tf')
+   parser.add_argument("--checkpoint", help="tf checkpoint, or .npz export for the numpy engine", default='./checkpoints/model.ckpt')
+   parser.add_argument("--tile_size", help="size of the tiles, rounded up to a multiple of 16", type=int, default=512)
+   parser.add_argument("--batch_size", help="number of tiles per forward pass of the tf engine", type=int, default=1)
+   parser.add_argument("--algorithm", help="harmonic convolution algorithm {auto,direct,fft,basis,gauss}", default='auto')
+   parser.add_argument("--precision", help="precision of the harmonic layers {float32,float16}, in which their convolutions also accumulate", default='float32')
+   parser.add_argument("--real_order0", help="keep the order 0 filters of the first layer real, so the exported filter bank leaves out their zero imaginary response, which harmonic_network_numpy then skips (tensorflow still computes it)", type=bool, default=False)
+   main(parser.parse_args())
@@ -1,6 +1,7 @@
 '''Run BSD500'''
 
 import argparse
+import multiprocessing as mp
 import os
 import shutil
 import sys
@@ -9,13 +10,13 @@ sys.path.append('../')
 
 import cPickle as pkl
 import numpy as np
-import skimage.exposure as skiex
 import skimage.io as skio
 import tensorflow as tf
 
 sess=tf.Session() # no idea why I have to do this
 sess.close()
 import BSD_model
+import harmonic_network_lite as hl
 
 
 def make_dirs(args, directory):
@@ -83,45 +84,132 @@ def settings(args):
 
 def pklbatcher(inputs, targets, batch_size, shuffle=False, augment=False,
                 img_shape=(321,481,3)):
-    """Input and target are minibatched. Returns a generator"""
+    """Input and target are minibatched. Returns a generator. Without
+    shuffling, the last batch holds the remaining examples."""
     assert len(inputs) == len(targets)
     indices = inputs.keys()
     if shuffle:
         np.random.shuffle(indices)
-    for start_idx in range(0, len(inputs) - batch_size + 1, batch_size):
+        stop = len(inputs) - batch_size + 1
+    else:
+        stop = len(inputs)
+    for start_idx in range(0, stop, batch_size):
         if shuffle:
             excerpt = indices[start_idx:start_idx + batch_size]
         else:
             excerpt = indices[start_idx:start_idx+batch_size]
-        # Data augmentation
-        im = []
-        targ = []
-        for i in xrange(len(excerpt)):
-            img = inputs[excerpt[i]]['x']
-            tg = targets[excerpt[i]]['y'] > 2
-            if augment:
-                # We use shuffle as a proxy for training
-                if shuffle:
-                    img, tg = bsd_preprocess(img, tg)
-            im.append(img)
-            targ.append(tg)
-        im = np.stack(im, axis=0)
-        targ = np.stack(targ, axis=0)
+        # We use shuffle as a proxy for training
+        im, targ = load_batch(inputs, targets, excerpt,
+                              augment=(augment and shuffle))
         yield im, targ, excerpt
 
 
+def load_batch(inputs, targets, excerpt, augment=False):
+    """Stack the images and edge maps of the keys in excerpt, with data
+    augmentation if augment"""
+    im = np.stack([inputs[key]['x'] for key in excerpt], axis=0)
+    targ = np.stack([targets[key]['y'] > 2 for key in excerpt], axis=0)
+    if augment:
+        im, targ = bsd_preprocess(im, targ)
+    return im, targ
+
+
+def augmenter(inputs, targets, batch_size, epoch, seed=0, n_workers=2,
+              n_prefetch=4, stats=None):
+    """Shuffled and augmented minibatches, as from pklbatcher with shuffle
+    and augment, prepared by n_workers forked processes. Worker w prepares
+    every n_workers-th batch, starting at batch w, into its own bounded queue
+    of max(n_prefetch // n_workers, 1) batches, so that together they keep
+    n_prefetch batches, rounded down to a multiple of n_workers but at least
+    one per worker, ready while the training step runs, and the batches
+    arrive in order. The shuffle is seeded by (seed, epoch) and the
+    augmentation of batch j by (seed, epoch, j), so an epoch is the same for
+    any number of workers. Errors of the workers are raised in the caller.
+
+    inputs, targets: dataset dicts, as for pklbatcher
+    batch_size: minibatch size
+    epoch: epoch number, for the seeds
+    seed: base seed (default 0)
+    n_workers: number of worker processes (default 2)
+    n_prefetch: number of batches kept ready (default 4)
+    stats: dict which, if given, is filled with the number of batches
+    'n_batches', the time in seconds spent waiting for them 'wait', the sum
+    'depth' of the number of batches ready when each was asked for, and the
+    number of batches which can be ready 'capacity'
+    """
+    assert len(inputs) == len(targets)
+    indices = sorted(inputs.keys())
+    np.random.RandomState([seed, epoch]).shuffle(indices)
+    excerpts = [indices[start_idx:start_idx + batch_size] for start_idx in
+                xrange(0, len(indices) - batch_size + 1, batch_size)]
+    queue_size = max(n_prefetch // n_workers, 1)
+    queues = [mp.Queue(maxsize=queue_size) for __ in xrange(n_workers)]
+    # Batches in the queues. Queue.qsize is not implemented on all
+    # platforms, e.g. macOS, so the workers and the caller count them
+    ready = mp.Value('i', 0)
+    def produce(worker):
+        try:
+            for j in xrange(worker, len(excerpts), n_workers):
+                np.random.seed([seed, epoch, j])
+                im, targ = load_batch(inputs, targets, excerpts[j], augment=True)
+                queues[worker].put((im, targ, excerpts[j]))
+                with ready.get_lock():
+                    ready.value += 1
+        except Exception as e:
+            queues[worker].put(e)
+    workers = [mp.Process(target=produce, args=(w,)) for w in xrange(n_workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    if stats is not None:
+        stats.update({'n_batches': 0, 'wait': 0., 'depth': 0,
+                      'capacity': n_workers*queue_size})
+    try:
+        for j in xrange(len(excerpts)):
+            queue = queues[j % n_workers]
+            if stats is not None:
+                stats['depth'] += ready.value
+                wait_start = time.time()
+            batch = queue.get()
+            if not isinstance(batch, Exception):
+                with ready.get_lock():
+                    ready.value -= 1
+            if stats is not None:
+                stats['wait'] += time.time() - wait_start
+                stats['n_batches'] += 1
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        # Stop the workers if the epoch is cut short
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
 def bsd_preprocess(im, tg):
-    '''Data normalizations and augmentations'''
-    fliplr = (np.random.rand() > 0.5)
-    flipud = (np.random.rand() > 0.5)
-    gamma = np.minimum(np.maximum(1. + np.random.randn(), 0.5), 1.5)
-    if fliplr:
-        im = np.fliplr(im)
-        tg = np.fliplr(tg)
-    if flipud:
-        im = np.flipud(im)
-        tg = np.flipud(tg)
-    im = skiex.adjust_gamma(im, gamma)
+    '''Data normalizations and augmentations of a batch. Each image is
+    flipped left-right and up-down with probability 0.5, and gamma corrected
+    with a gamma drawn from N(1,1) clipped to [0.5,1.5], as
+    skimage.exposure.adjust_gamma would. The random draws and the
+    operations are done for the whole batch at once. Returns new float32
+    images and new edge maps.
+
+    im: images, shape [batch_size,height,width,channels] in [0,1]
+    tg: edge maps, shape [batch_size,height,width,...]
+    '''
+    n = im.shape[0]
+    fliplr = np.random.rand(n) > 0.5
+    flipud = np.random.rand(n) > 0.5
+    gamma = np.minimum(np.maximum(1. + np.random.randn(n), 0.5), 1.5)
+    im = np.power(np.asarray(im, dtype=np.float32),
+                  np.reshape(gamma, [n,1,1,1]).astype(np.float32))
+    tg = np.array(tg)
+    # Flip the selected images in place, on reversed views
+    for x in (im, tg):
+        x[fliplr] = x[fliplr,:,::-1]
+        x[flipud] = x[flipud,::-1]
     return im, tg
 
 
@@ -155,10 +243,10 @@ def main(args):
    args, data = settings(args)
 
    # BUILD MODEL
-   ## Placeholders
+   ## Placeholders, of any batch and image size
    print('...Creating network input')
-   x = tf.placeholder(tf.float32, [args.batch_size,args.height,args.width,3], name='x')
-   y = tf.placeholder(tf.float32, [args.batch_size,args.height,args.width,1], name='y')
+   x = tf.placeholder(tf.float32, [None,None,None,3], name='x')
+   y = tf.placeholder(tf.float32, [None,None,None,1], name='y')
    learning_rate = tf.placeholder(tf.float32, name='learning_rate')
    train_phase = tf.placeholder(tf.bool, name='train_phase')
 
@@ -167,7 +255,16 @@ def main(args):
    if args.mode == 'baseline':
       pred = BSD_model.vgg_bsd(args, x, train_phase)
    elif args.mode == 'hnet':
-      pred = BSD_model.hnet_bsd(args, x, train_phase)
+      # The layers are autotuned and sized like those of the model on a
+      # batch of 321x481 images
+      representative = tf.Graph()
+      with representative.as_default():
+         x_ = tf.placeholder(tf.float32, [args.batch_size,args.height,args.width,3])
+         BSD_model.hnet_bsd(args, x_, tf.placeholder(tf.bool))
+      # Filters are only rebuilt for validation after weight updates
+      with hl.filter_cache(tf.logical_not(train_phase)):
+         with hl.representative(representative):
+            pred = BSD_model.hnet_bsd(args, x, train_phase)
    else:
       print('Must execute script with valid --mode flag: "hnet" or "baseline"')
       sys.exit(-1)
@@ -178,6 +275,15 @@ def main(args):
    for var in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
       n_vars += np.prod(var.get_shape().as_list())
    print('...Number of parameters: {:d}'.format(n_vars))
+   blocks = hl.checkpoint_info()
+   if len(blocks) > 0 and blocks[0]['activations'] is None:
+      print('...Checkpointed {:d} blocks'.format(len(blocks)))
+   elif len(blocks) > 0:
+      recomputed = sum([b['activations'] for b in blocks])*4./2**20
+      kept = sum([b['boundary'] for b in blocks])*4./2**20
+      print('...Checkpointed {:d} blocks: ~{:.0f}MB of activations recomputed '
+            'in one extra forward pass per block, {:.0f}MB of block boundaries '
+            'kept'.format(len(blocks), recomputed, kept))
 
    print('...Building loss')
    loss = 0.
@@ -193,6 +299,7 @@ def main(args):
    print('...Building optimizer')
    optim = tf.train.AdamOptimizer(learning_rate=learning_rate)
    train_op = optim.minimize(loss)
+   train_op = hl.invalidate_filter_cache(train_op)
 
    # TRAIN
    print('TRAINING')
@@ -209,7 +316,13 @@ def main(args):
 
    while epoch < args.n_epochs:
       # Training steps
-      batcher = pklbatcher(data['train_x'], data['train_y'], args.batch_size, shuffle=True, augment=True)
+      stats = {}
+      if args.n_workers > 0:
+         batcher = augmenter(data['train_x'], data['train_y'], args.batch_size,
+            epoch, seed=args.seed, n_workers=args.n_workers,
+            n_prefetch=args.n_prefetch, stats=stats)
+      else:
+         batcher = pklbatcher(data['train_x'], data['train_y'], args.batch_size, shuffle=True, augment=True)
       train_loss = 0.
       for i, (X, Y, __) in enumerate(batcher):
          feed_dict = {x: X, y: Y, learning_rate: lr, train_phase: True}
@@ -221,6 +334,10 @@ def main(args):
 
       print('[{:04d} | {:0.1f}] Loss: {:04f}, Learning rate: {:.2e}'.format(epoch,
          time.time() - start, train_loss, lr))
+      if stats.get('n_batches', 0) > 0:
+         print('Data wait: {:.2f}ms/step, Batches ready: {:.1f}/{:d}'.format(
+            1000.*stats['wait']/stats['n_batches'],
+            float(stats['depth'])/stats['n_batches'], stats['capacity']))
 
       if epoch % args.save_step == 0:
          # Validate
@@ -234,15 +351,21 @@ def main(args):
          j = 0
          for batch in generator:
             batch_x, batch_y, excerpt = batch
-            output = sess.run(bsd_map, feed_dict={x: batch_x, train_phase: False})
-            for i in xrange(output.shape[0]):
-               save_name = save_path + '/' + str(excerpt[i]).replace('.jpg','.png')
-               im = output[i,:,:,0]
-               im = (255*im).astype('uint8')
-               if data['valid_x'][excerpt[i]]['transposed']:
-                  im = im.T
-               skio.imsave(save_name, im)
-               j += 1
+            # Portrait images are stored transposed, so we run them upright
+            for transposed in (False, True):
+               idx = [i for i in xrange(len(excerpt))
+                      if data['valid_x'][excerpt[i]]['transposed'] == transposed]
+               if len(idx) == 0:
+                  continue
+               X = batch_x[idx]
+               if transposed:
+                  X = np.transpose(X, (0,2,1,3))
+               output = sess.run(bsd_map, feed_dict={x: X, train_phase: False})
+               for i, im in zip(idx, output):
+                  save_name = save_path + '/' + str(excerpt[i]).replace('.jpg','.png')
+                  im = (255*im[:,:,0]).astype('uint8')
+                  skio.imsave(save_name, im)
+                  j += 1
          print('Saved predictions to: %s' % (save_path,))
 
       # Updates to the training scheme
@@ -251,7 +374,11 @@ def main(args):
       epoch += 1
 
       # Save model
-      saver.save(sess, args.checkpoint_path + 'model.ckpt')
+      saver.save(sess, os.path.join(args.checkpoint_path, 'model.ckpt'))
+   if args.mode == 'hnet':
+      # Export for inference without tensorflow, see BSD_model_numpy.py
+      hl.export(sess, os.path.join(args.checkpoint_path, 'model.npz'),
+         feed_dict={train_phase: False})
    sess.close()
    return train_loss
 
@@ -264,4 +391,11 @@ if __name__ == '__main__':
    parser.add_argument("--default_settings", help="use default settings", type=bool, default=True)
    parser.add_argument("--combine_train_val", help="combine the training and validation sets for testing", type=bool, default=False)
    parser.add_argument("--delete_existing", help="delete the existing auxilliary files", type=bool, default=True)
+   parser.add_argument("--algorithm", help="harmonic convolution algorithm {auto,direct,fft,basis,gauss}", default='auto')
+   parser.add_argument("--precision", help="precision of the harmonic layers {float32,float16}, in which their convolutions also accumulate", default='float32')
+   parser.add_argument("--real_order0", help="keep the order 0 filters of the first layer real, so the exported filter bank leaves out their zero imaginary response, which harmonic_network_numpy then skips (tensorflow still computes it)", type=bool, default=False)
+   parser.add_argument("--checkpoint_blocks", help="recompute the activations of each hnet block in the backward pass", type=bool, default=False)
+   parser.add_argument("--n_workers", help="number of processes augmenting the training batches, 0 to augment them synchronously", type=int, default=2)
+   parser.add_argument("--n_prefetch", help="number of augmented training batches kept ready, rounded down to a multiple of n_workers", type=int, default=4)
+   parser.add_argument("--seed", help="seed of the shuffling and augmentation of the training batches", type=int, default=0)
    main(parser.parse_args())
@@ -0,0 +1,48 @@
+'''MNIST-rot model in NumPy, for inference without tensorflow'''
+
+import os
+import sys
+sys.path.append('../')
+
+import numpy as np
+
+import harmonic_network_numpy as hn_np
+
+
+def deep_mnist(args, x, params):
+   """Forward pass of mnist_model.deep_mnist in test mode, with the
+   parameters from harmonic_network_lite.export, see harmonic_network_numpy.
+   Returns the logits.
+
+   args: settings, as for mnist_model.deep_mnist
+   x: array of flattened images, shape [batchsize,784]
+   params: dict from harmonic_network_numpy.load
+   """
+   x = np.reshape(x, [-1,args.dim,args.dim,1,1,1]).astype(np.float32)
+
+   # Convolutional Layers with pooling
+   cv1 = hn_np.conv2d(x, params, padding='SAME', name='1')
+   cv1 = hn_np.non_linearity(cv1, params, name='1')
+
+   cv2 = hn_np.conv2d(cv1, params, padding='SAME', name='2')
+   cv2 = hn_np.batch_norm(cv2, params, name='bn1')
+
+   cv2 = hn_np.mean_pool(cv2, ksize=(1,2,2,1), strides=(1,2,2,1))
+   cv3 = hn_np.conv2d(cv2, params, padding='SAME', name='3')
+   cv3 = hn_np.non_linearity(cv3, params, name='3')
+
+   cv4 = hn_np.conv2d(cv3, params, padding='SAME', name='4')
+   cv4 = hn_np.batch_norm(cv4, params, name='bn2')
+
+   cv4 = hn_np.mean_pool(cv4, ksize=(1,2,2,1), strides=(1,2,2,1))
+   cv5 = hn_np.conv2d(cv4, params, padding='SAME', name='5')
+   cv5 = hn_np.non_linearity(cv5, params, name='5')
+
+   cv6 = hn_np.conv2d(cv5, params, padding='SAME', name='6')
+   cv6 = hn_np.batch_norm(cv6, params, name='bn3')
+
+   # Final Layer
+   cv7 = hn_np.conv2d(cv6, params, padding='SAME', name='7')
+   real = hn_np.sum_magnitudes(cv7)
+   cv7 = np.mean(real, axis=(1,2,3,4))
+   return cv7 + params['b7']
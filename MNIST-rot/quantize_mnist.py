@@ -0,0 +1,144 @@
+"""Post-training int8 quantization of a trained MNIST-rot model"""
+
+import argparse
+import os
+import sys
+sys.path.append('../')
+
+import numpy as np
+import tensorflow as tf
+
+import harmonic_network_lite as hn_lite
+from mnist_model import deep_mnist
+import run_mnist
+from run_mnist import minibatcher, settings
+
+
+def quantize_weights(W, n_bits=8):
+   """Quantize radial profiles, shape [n_rings,in,out], symmetrically to
+   signed integers with one scale per output channel. The basis rings are
+   fixed, so the filters stay exactly steerable.
+   """
+   levels = 2.**(n_bits-1) - 1.
+   scale = np.maximum(np.amax(np.abs(W), axis=(0,1), keepdims=True), 1e-12) / levels
+   return np.round(W / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def quantize_phases(psi, n_bits=8):
+   """Quantize phase offsets to n_bits angles on [0, 2pi)"""
+   step = 2.*np.pi / 2.**n_bits
+   return (np.round(psi / step) % 2**n_bits).astype(np.uint8), step
+
+
+def build(args, frozen=None, ranges=None):
+   """Build the inference graph, from precomputed filters and quantized
+   activations if given. Returns the placeholders, the predictions and the
+   number of correct predictions.
+   """
+   tf.reset_default_graph()
+   x = tf.placeholder(tf.float32, [None,784], name='x')
+   y = tf.placeholder(tf.int64, [None], name='y')
+   train_phase = tf.placeholder(tf.bool, name='train_phase')
+   if frozen is None:
+      pred = deep_mnist(args, x, train_phase)
+   else:
+      with hn_lite.frozen(frozen), hn_lite.quantized(ranges, n_bits=args.n_bits):
+         pred = deep_mnist(args, x, train_phase)
+   n_correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(pred, 1), y), tf.int32))
+   return x, y, train_phase, pred, n_correct
+
+
+def evaluate(sess, args, data, x, y, train_phase, pred, n_correct):
+   """Return the exact test accuracy on all test examples and the rotation
+   error of a model"""
+   test_acc, __ = run_mnist.evaluate(sess, n_correct, x, y, data['test_x'],
+      data['test_y'], args.eval_batch_size, feed_dict={train_phase: False})
+   def predict(X):
+      return sess.run(pred, feed_dict={x: X.reshape(-1,784), train_phase: False})
+   X = data['test_x'][:args.batch_size].reshape(-1,args.dim,args.dim)
+   return test_acc, hn_lite.rotation_error(predict, X)
+
+
+def main(args):
+   """Quantize a trained model and compare it against the float model"""
+   args, data = settings(args)
+   if args.checkpoint is not None:
+      args.checkpoint_path = args.checkpoint
+   config = tf.ConfigProto()
+   config.gpu_options.allow_growth = True
+   hn_lite.set_autotune_config(config)
+
+   ##### FLOAT MODEL #####
+   x, y, train_phase, pred, n_correct = build(args)
+   sess = tf.Session(config=config)
+   sess.run(tf.global_variables_initializer())
+   hn_lite.restore_variables(sess, args.checkpoint_path)
+   float_acc, float_err = evaluate(sess, args, data, x, y, train_phase, pred, n_correct)
+   print('Float Test Acc.: {:04f}, Rotation error: {:.2e}'.format(float_acc, float_err))
+
+   ##### CALIBRATION #####
+   # Largest magnitude per rotation order and channel of every layer output
+   outputs = hn_lite.layer_outputs()
+   names = sorted(outputs.keys())
+   peaks = [tf.reduce_max(hn_lite.stack_magnitudes(outputs[n]), axis=[0,1,2])
+            for n in names]
+   ranges = {}
+   batcher = minibatcher(data['train_x'], data['train_y'], args.batch_size, shuffle=True)
+   for i, (X, Y) in enumerate(batcher):
+      if i == args.n_calibration:
+         break
+      peaks_ = sess.run(peaks, feed_dict={x: X, train_phase: False})
+      for n, p in zip(names, peaks_):
+         ranges[n] = np.maximum(ranges.get(n, 0.), p)
+
+   ##### WEIGHTS #####
+   # Quantize the radial profiles and phases, then bake the dequantized
+   # weights into the filters
+   quantized = {}
+   assign_ops = []
+   for v in tf.trainable_variables():
+      name = v.op.name
+      value = sess.run(v)
+      if name.startswith('W') and value.ndim == 3:
+         q, scale = quantize_weights(value, n_bits=args.n_bits)
+         quantized[name] = q
+         quantized[name+'_scale'] = scale
+         assign_ops.append(v.assign(q.astype(np.float32)*scale))
+      elif name.startswith('phase'):
+         q, step = quantize_phases(value, n_bits=args.n_bits)
+         quantized[name] = q
+         assign_ops.append(v.assign(q.astype(np.float32)*step))
+   sess.run(assign_ops)
+   params = hn_lite.freeze(sess, feed_dict={train_phase: False})
+   sess.close()
+   for n in names:
+      quantized['range_'+n] = ranges[n]
+   np.savez(args.output, **quantized)
+   print('Saved {:d} quantized weights and {:d} activation ranges to {:s}'.format(
+      len(quantized)-len(names), len(names), args.output))
+
+   ##### QUANTIZED MODEL #####
+   x, y, train_phase, pred, n_correct = build(args, frozen=params, ranges=ranges)
+   sess = tf.Session(config=config)
+   sess.run(tf.global_variables_initializer())
+   hn_lite.restore_variables(sess, args.checkpoint_path)
+   quant_acc, quant_err = evaluate(sess, args, data, x, y, train_phase, pred, n_correct)
+   sess.close()
+   print('int{:d} Test Acc.: {:04f} ({:+04f}), Rotation error: {:.2e} (float {:.2e})'.format(
+      args.n_bits, quant_acc, quant_acc-float_acc, quant_err, float_err))
+
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--data_dir", help="data directory", default='./data')
+   parser.add_argument("--default_settings", help="use default settings", type=bool, default=True)
+   parser.add_argument("--combine_train_val", help="combine the training and validation sets for testing", type=bool, default=False)
+   parser.add_argument("--algorithm", help="harmonic convolution algorithm {auto,direct,fft,basis,gauss}", default='auto')
+   parser.add_argument("--precision", help="precision of the harmonic layers {float32,float16}, in which their convolutions also accumulate", default='float32')
+   parser.add_argument("--real_order0", help="keep the order 0 filters of the first layer real, so the exported filter bank leaves out their zero imaginary response, which harmonic_network_numpy then skips (tensorflow still computes it)", type=bool, default=False)
+   parser.add_argument("--eval_batch_size", help="batch size for testing", type=int, default=500)
+   parser.add_argument("--checkpoint", help="checkpoint to quantize (default ./checkpoints/model.ckpt)", default=None)
+   parser.add_argument("--n_bits", help="bits per weight and activation", type=int, default=8)
+   parser.add_argument("--n_calibration", help="number of training batches to calibrate activation ranges on", type=int, default=20)
+   parser.add_argument("--output", help="file for the quantized weights", default='./quantized_mnist.npz')
+   main(parser.parse_args())
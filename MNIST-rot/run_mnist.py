@@ -2,8 +2,10 @@
 
 import argparse
 import os
+import Queue
 import random
 import sys
+import threading
 import time
 import urllib2
 import zipfile
@@ -12,6 +14,7 @@ sys.path.append('../')
 import numpy as np
 import tensorflow as tf
 
+import harmonic_network_lite as hn_lite
 from mnist_model import deep_mnist
 
 
@@ -92,18 +95,92 @@ def add_folder(folder_name):
    return folder_name
 
 
-def minibatcher(inputs, targets, batchsize, shuffle=False):
+def minibatcher(inputs, targets, batchsize, shuffle=False, keep_remainder=False):
+   """Yield minibatches, and with keep_remainder a last smaller batch of
+   the remaining examples"""
    assert len(inputs) == len(targets)
    if shuffle:
       indices = np.arange(len(inputs))
       np.random.shuffle(indices)
-   for start_idx in range(0, len(inputs) - batchsize + 1, batchsize):
+   stop = len(inputs) if keep_remainder else len(inputs) - batchsize + 1
+   for start_idx in range(0, stop, batchsize):
       if shuffle:
          excerpt = indices[start_idx:start_idx + batchsize]
       else:
          excerpt = slice(start_idx, start_idx + batchsize)
       yield inputs[excerpt], targets[excerpt]
 
+def prefetcher(batcher, n_batches):
+   """Run a minibatch generator on a background thread, which keeps up to
+   n_batches float32 batches ready while the training step runs. Errors of
+   the generator are raised in the caller.
+   """
+   queue = Queue.Queue(maxsize=n_batches)
+   def produce():
+      try:
+         for X, Y in batcher:
+            queue.put((np.ascontiguousarray(X, dtype=np.float32), Y))
+         queue.put(None)
+      except Exception as e:
+         queue.put(e)
+   thread = threading.Thread(target=produce)
+   thread.daemon = True
+   thread.start()
+   while True:
+      batch = queue.get()
+      if batch is None:
+         return
+      if isinstance(batch, Exception):
+         raise batch
+      yield batch
+
+
+def device_dataset(inputs, targets, batch_size):
+   """Keep a dataset in graph variables and draw shuffled minibatches from it
+   in the graph, so that no data is fed per step. Returns the batch tensors
+   (x, y), an op reshuffling the dataset for a new epoch, the variable
+   counting the batches drawn in the epoch, which the training step has to
+   increment, and the feeds with which to initialize the local variables.
+
+   inputs, targets: numpy dataset
+   batch_size: minibatch size
+   """
+   n = len(inputs)
+   local = [tf.GraphKeys.LOCAL_VARIABLES]
+   inputs_init = tf.placeholder(tf.float32, inputs.shape)
+   targets_init = tf.placeholder(tf.int64, targets.shape)
+   inputs_ = tf.Variable(inputs_init, trainable=False, collections=local, name='train_x')
+   targets_ = tf.Variable(targets_init, trainable=False, collections=local, name='train_y')
+   permutation = tf.Variable(tf.range(n), trainable=False, collections=local, name='permutation')
+   step = tf.Variable(0, trainable=False, collections=local, name='step')
+   reshuffle = tf.group(tf.assign(permutation, tf.random_shuffle(tf.range(n))),
+                        tf.assign(step, 0))
+   indices = tf.slice(permutation, tf.expand_dims(step*batch_size, 0), [batch_size])
+   x = tf.gather(inputs_, indices)
+   y = tf.gather(targets_, indices)
+   return x, y, reshuffle, step, {inputs_init: inputs, targets_init: targets}
+
+
+def evaluate(sess, n_correct, x, y, inputs, targets, batch_size, feed_dict=None):
+   """Return the exact accuracy of a model on all examples, and the number
+   of examples per second
+
+   sess: tf session
+   n_correct: tensor counting the correct predictions in a batch
+   x, y: input and target placeholders of any batch size
+   inputs, targets: numpy dataset
+   batch_size: evaluation batch size
+   feed_dict: other feeds (default None)
+   """
+   feed_dict = dict(feed_dict or {})
+   correct = 0
+   start = time.time()
+   for X, Y in minibatcher(inputs, targets, batch_size, keep_remainder=True):
+      feed_dict.update({x: X, y: Y})
+      correct += sess.run(n_correct, feed_dict=feed_dict)
+   return correct / float(len(inputs)), len(inputs) / (time.time() - start)
+
+
 def get_learning_rate(args, current, best, counter, learning_rate):
    """If have not seen accuracy improvement in delay epochs, then divide 
    learning rate by 10
@@ -124,11 +201,26 @@ def main(args):
    tf.reset_default_graph()
    ##### SETUP AND LOAD DATA #####
    args, data = settings(args)
+   config = tf.ConfigProto()
+   config.gpu_options.allow_growth = True
+   config.log_device_placement = False
+   # Some of the in-graph batching ops only run on the cpu
+   config.allow_soft_placement = args.device_data
+   # Autotune the layers with the same settings
+   hn_lite.set_autotune_config(config)
    
    ##### BUILD MODEL #####
-   ## Placeholders
-   x = tf.placeholder(tf.float32, [args.batch_size,784], name='x')
-   y = tf.placeholder(tf.int64, [args.batch_size], name='y')
+   ## Placeholders, of any batch size. With device_data they default to
+   ## training batches drawn in the graph
+   init_feed = {}
+   if args.device_data:
+      x_batch, y_batch, reshuffle, step, init_feed = device_dataset(data['train_x'],
+         data['train_y'], args.batch_size)
+      x = tf.placeholder_with_default(x_batch, [None,784], name='x')
+      y = tf.placeholder_with_default(y_batch, [None], name='y')
+   else:
+      x = tf.placeholder(tf.float32, [None,784], name='x')
+      y = tf.placeholder(tf.int64, [None], name='y')
    learning_rate = tf.placeholder(tf.float32, name='learning_rate')
    train_phase = tf.placeholder(tf.bool, name='train_phase')
 
@@ -140,6 +232,14 @@ def main(args):
    correct_pred = tf.equal(tf.argmax(pred, 1), y)
    accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
 
+   # Inference copy of the model for validation. It shares the weights,
+   # applies the population statistics without a tf.cond, and its filters
+   # are only rebuilt after weight updates
+   with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      with hn_lite.filter_cache(tf.constant(True)):
+         pred_eval = deep_mnist(args, x, None)
+   n_correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(pred_eval, 1), y), tf.int32))
+
    # Optimizer
    optim = tf.train.AdamOptimizer(learning_rate=learning_rate)
    grads_and_vars = optim.compute_gradients(loss)
@@ -150,19 +250,22 @@ def main(args):
          g = args.phase_preconditioner*g
       modified_gvs.append((g, v))
    train_op = optim.apply_gradients(modified_gvs)
+   train_op = hn_lite.invalidate_filter_cache(train_op)
+   if args.device_data:
+      # Move on to the next batch after each step
+      with tf.control_dependencies([train_op]):
+         train_op = tf.assign_add(step, 1)
    
    ##### TRAIN ####
    # Configure tensorflow session
    init_global = tf.global_variables_initializer()
    init_local = tf.local_variables_initializer()
-   config = tf.ConfigProto()
-   config.gpu_options.allow_growth = True
-   config.log_device_placement = False
    
    lr = args.learning_rate
    saver = tf.train.Saver()
    sess = tf.Session(config=config)
-   sess.run([init_global, init_local], feed_dict={train_phase : True})
+   init_feed[train_phase] = True
+   sess.run([init_global, init_local], feed_dict=init_feed)
    
    start = time.time()
    epoch = 0
@@ -172,34 +275,45 @@ def main(args):
    print('Starting training loop...')
    while epoch < args.n_epochs:
       # Training steps
-      batcher = minibatcher(data['train_x'], data['train_y'], args.batch_size, shuffle=True)
+      if args.device_data:
+         # The batches are drawn in the graph
+         sess.run(reshuffle)
+         n_batches = len(data['train_x']) / args.batch_size
+         batcher = ((None, None) for __ in xrange(n_batches))
+      else:
+         batcher = minibatcher(data['train_x'], data['train_y'], args.batch_size, shuffle=True)
+         if args.prefetch > 0:
+            batcher = prefetcher(batcher, args.prefetch)
       train_loss = 0.
       train_acc = 0.
+      # Time spent waiting for the next batch
+      data_wait = 0.
+      wait_start = time.time()
       for i, (X, Y) in enumerate(batcher):
-         feed_dict = {x: X, y: Y, learning_rate: lr, train_phase: True}
+         data_wait += time.time() - wait_start
+         feed_dict = {learning_rate: lr, train_phase: True}
+         if X is not None:
+            feed_dict.update({x: X, y: Y})
          __, loss_, accuracy_ = sess.run([train_op, loss, accuracy], feed_dict=feed_dict)
          train_loss += loss_
          train_acc += accuracy_
          sys.stdout.write('{:d}/{:d}\r'.format(i, data['train_x'].shape[0]/args.batch_size))
          sys.stdout.flush()
+         wait_start = time.time()
       train_loss /= (i+1.)
       train_acc /= (i+1.)
+      data_wait *= 1000./(i+1.)
       
       if not args.combine_train_val:
-         batcher = minibatcher(data['valid_x'], data['valid_y'], args.batch_size)
-         valid_acc = 0.
-         for i, (X, Y) in enumerate(batcher):
-            feed_dict = {x: X, y: Y, train_phase: False}
-            accuracy_ = sess.run(accuracy, feed_dict=feed_dict)
-            valid_acc += accuracy_
-            sys.stdout.write('Validating\r')
-            sys.stdout.flush()
-         valid_acc /= (i+1.)
-         print('[{:04d} | {:0.1f}] Loss: {:04f}, Train Acc.: {:04f}, Validation Acc.: {:04f}, Learning rate: {:.2e}'.format(epoch,
-            time.time()-start, train_loss, train_acc, valid_acc, lr))
+         sys.stdout.write('Validating\r')
+         sys.stdout.flush()
+         valid_acc, rate = evaluate(sess, n_correct, x, y, data['valid_x'],
+            data['valid_y'], args.eval_batch_size)
+         print('[{:04d} | {:0.1f}] Loss: {:04f}, Train Acc.: {:04f}, Validation Acc.: {:04f} ({:.0f} ex/s), Learning rate: {:.2e}, Data wait: {:.2f}ms/step'.format(epoch,
+            time.time()-start, train_loss, train_acc, valid_acc, rate, lr, data_wait))
       else:
-         print('[{:04d} | {:0.1f}] Loss: {:04f}, Train Acc.: {:04f}, Learning rate: {:.2e}'.format(epoch,
-            time.time()-start, train_loss, train_acc, lr))
+         print('[{:04d} | {:0.1f}] Loss: {:04f}, Train Acc.: {:04f}, Learning rate: {:.2e}, Data wait: {:.2f}ms/step'.format(epoch,
+            time.time()-start, train_loss, train_acc, lr, data_wait))
             
       # Save model
       if epoch % 10 == 0:
@@ -211,18 +325,36 @@ def main(args):
       lr = args.learning_rate * np.power(0.1, epoch / 50)
       epoch += 1
 
-   # TEST
-   batcher = minibatcher(data['test_x'], data['test_y'], args.batch_size)
-   test_acc = 0.
-   for i, (X, Y) in enumerate(batcher):
-      feed_dict = {x: X, y: Y, train_phase: False}
-      accuracy_ = sess.run(accuracy, feed_dict=feed_dict)
-      test_acc += accuracy_
-      sys.stdout.write('Testing\r')
-      sys.stdout.flush()
-   test_acc /= (i+1.)
-   
-   print('Test Acc.: {:04f}'.format(test_acc))
+   # TEST, in a new graph with the trained filters and batch norms baked in
+   saver.save(sess, args.checkpoint_path)
+   params = hn_lite.freeze(sess, feed_dict={train_phase: False})
+   # Export for inference without tensorflow, see mnist_model_numpy.py
+   hn_lite.export(sess, os.path.splitext(args.checkpoint_path)[0] + '.npz',
+      feed_dict={train_phase: False}, config=config)
+   sess.close()
+   tf.reset_default_graph()
+   x = tf.placeholder(tf.float32, [None,784], name='x')
+   y = tf.placeholder(tf.int64, [None], name='y')
+   train_phase = tf.placeholder(tf.bool, name='train_phase')
+   with hn_lite.frozen(params):
+      pred = deep_mnist(args, x, train_phase)
+   n_correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(pred, 1), y), tf.int32))
+   sess = tf.Session(config=config)
+   sess.run(tf.global_variables_initializer())
+   hn_lite.restore_variables(sess, args.checkpoint_path)
+
+   sys.stdout.write('Testing\r')
+   sys.stdout.flush()
+   test_acc, rate = evaluate(sess, n_correct, x, y, data['test_x'],
+      data['test_y'], args.eval_batch_size, feed_dict={train_phase: False})
+   print('Test Acc.: {:04f} on {:d} examples ({:.0f} ex/s)'.format(test_acc,
+      len(data['test_x']), rate))
+   # Numerical error of the rotation invariance, e.g. due to the precision
+   def predict(X):
+      return sess.run(pred, feed_dict={x: X.reshape(-1,784), train_phase: False})
+   X = data['test_x'][:args.batch_size].reshape(-1,args.dim,args.dim)
+   print('Rotation error ({:s}): {:.2e}'.format(args.precision,
+      hn_lite.rotation_error(predict, X)))
    sess.close()
       
 
@@ -231,6 +363,12 @@ if __name__ == '__main__':
    parser.add_argument("--data_dir", help="data directory", default='./data')
    parser.add_argument("--default_settings", help="use default settings", type=bool, default=True)
    parser.add_argument("--combine_train_val", help="combine the training and validation sets for testing", type=bool, default=False)
+   parser.add_argument("--algorithm", help="harmonic convolution algorithm {auto,direct,fft,basis,gauss}", default='auto')
+   parser.add_argument("--precision", help="precision of the harmonic layers {float32,float16}, in which their convolutions also accumulate", default='float32')
+   parser.add_argument("--real_order0", help="keep the order 0 filters of the first layer real, so the exported filter bank leaves out their zero imaginary response, which harmonic_network_numpy then skips (tensorflow still computes it)", type=bool, default=False)
+   parser.add_argument("--device_data", help="keep the training set in the graph and draw the batches there", type=bool, default=False)
+   parser.add_argument("--prefetch", help="number of training batches prepared in the background, 0 to load them synchronously", type=int, default=4)
+   parser.add_argument("--eval_batch_size", help="batch size for validation and testing", type=int, default=500)
    main(parser.parse_args())
 
 
@@ -0,0 +1,49 @@
+'''Time to build the ring basis with the dense DFT and the ring quadrature'''
+
+import argparse
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+
+import harmonic_network_ops as hn
+
+
+def time_basis(filter_size, max_order, basis_type, n_trials=5):
+    """Return the fastest of n_trials constructions of the bases of orders
+    0,...,max_order in seconds, bypassing the basis cache"""
+    times = []
+    for i in xrange(n_trials):
+        hn.clear_basis_cache()
+        start = time.time()
+        for m in xrange(max_order+1):
+            hn.get_basis(filter_size, m, basis_type=basis_type)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    print('{:>4s} {:>10s} {:>12s} {:>8s} {:>10s}'.format('k', 'dft (ms)',
+          'quadr. (ms)', 'speedup', 'rel. err'))
+    for k in xrange(args.min_size, args.max_size+1, 2):
+        dft = time_basis(k, args.max_order, 'dft', n_trials=args.n_trials)
+        quadrature = time_basis(k, args.max_order, 'quadrature',
+                                n_trials=args.n_trials)
+        error = 0.
+        for m in xrange(args.max_order+1):
+            dense = np.vstack(hn.get_basis(k, m, basis_type='dft'))
+            quad = np.vstack(hn.get_basis(k, m, basis_type='quadrature'))
+            error = max(error, np.amax(np.abs(quad - dense)) /
+                        np.amax(np.abs(dense)))
+        print('{:4d} {:10.2f} {:12.2f} {:7.1f}x {:10.1e}'.format(k, 1000.*dft,
+              1000.*quadrature, dft/quadrature, error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min_size", help="smallest filter size", type=int, default=3)
+    parser.add_argument("--max_size", help="largest filter size", type=int, default=21)
+    parser.add_argument("--max_order", help="largest rotation order", type=int, default=3)
+    parser.add_argument("--n_trials", help="number of timed runs per setting", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+'''Peak memory of a hnet_bsd training step with and without checkpointing'''
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+sys.path.append('../')
+sys.path.append('../BSD500')
+
+
+def peak_rss():
+    """Peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(args):
+    """Build hnet_bsd, run a few training steps, and return the peak memory
+    in MB before and after the steps"""
+    import numpy as np
+    import tensorflow as tf
+    import BSD_model
+
+    x = tf.placeholder(tf.float32, [args.batch_size,args.height,args.width,3])
+    train_phase = tf.placeholder(tf.bool, name='train_phase')
+    pred = BSD_model.hnet_bsd(args, x, train_phase)
+    loss = tf.add_n([tf.reduce_mean(tf.nn.sigmoid(p)) for p in pred.values()])
+    train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(loss)
+    X = np.random.rand(args.batch_size, args.height, args.width, 3)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(),
+                  tf.local_variables_initializer()])
+        before = peak_rss()
+        start = time.time()
+        for i in xrange(args.n_steps):
+            sess.run(train_op, feed_dict={x: X, train_phase: True})
+        step_time = (time.time() - start) / args.n_steps
+    return before, peak_rss(), step_time
+
+
+def main(args):
+    """Measure each setting in its own process, so the peaks are separate"""
+    if args.worker:
+        print('{:f} {:f} {:f}'.format(*measure(args)))
+        return
+    print('hnet_bsd, batch {:d}, {:d}x{:d} images'.format(args.batch_size,
+          args.height, args.width))
+    for checkpoint_blocks in (False, True):
+        # type=bool flags are only false for the empty string
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', 'True',
+               '--checkpoint_blocks', 'True' if checkpoint_blocks else '']
+        for name in ('batch_size', 'height', 'width', 'n_steps',
+                     'algorithm'):
+            cmd += ['--'+name, str(getattr(args, name))]
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(cmd, stderr=devnull)
+        before, after, step_time = [float(v) for v in
+                                    output.strip().split('\n')[-1].split()]
+        print('checkpoint_blocks={!s:5}: peak {:.0f}MB, {:.0f}MB for the '
+              'training step, {:.2f}s/step'.format(checkpoint_blocks, after,
+              after - before, step_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--height", type=int, default=161)
+    parser.add_argument("--width", type=int, default=241)
+    parser.add_argument("--n_steps", help="number of training steps", type=int, default=2)
+    parser.add_argument("--algorithm", help="harmonic convolution algorithm {direct,fft,basis,gauss}", default='direct')
+    parser.add_argument("--checkpoint_blocks", type=bool, default=False)
+    parser.add_argument("--worker", help="measure one setting in this process", type=bool, default=False)
+    args = parser.parse_args()
+    # The configuration of run_BSD.py
+    args.std_mult = 0.8
+    args.filter_gain = 2
+    args.filter_size = 5
+    args.n_rings = 4
+    args.n_filters = 7
+    args.n_channels = 3
+    args.precision = 'float32'
+    args.real_order0 = False
+    main(args)
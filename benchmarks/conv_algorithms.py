@@ -0,0 +1,53 @@
+'''Crossover of the conv2d algorithms across image sizes, kernel sizes and
+channel counts'''
+
+import argparse
+import sys
+sys.path.append('../')
+
+import tensorflow as tf
+
+import harmonic_network_lite as hl
+
+
+def int_list(text):
+    return [int(v) for v in text.split(',')]
+
+
+def main(args):
+    algorithms = args.algorithms.split(',')
+    print('Forward and backward pass of a conv2d layer, batch {:d}, input orders '
+          '0,1 (complex), max_order 1, fastest of {:d} runs in ms'.format(
+          args.batch_size, args.n_trials))
+    print('{:>6s} {:>4s} {:>9s} '.format('size', 'k', 'channels') +
+          ' '.join(['{:>8s}'.format(a) for a in algorithms]) + '  fastest')
+    for size in args.sizes:
+        for ksize in args.ksizes:
+            for n_channels in args.channels:
+                x_shape = [args.batch_size, size, size, 2, 2, n_channels]
+                times = {}
+                for algorithm in algorithms:
+                    try:
+                        times[algorithm] = hl.time_conv2d(x_shape, n_channels,
+                            ksize, algorithm=algorithm, padding='SAME',
+                            n_trials=args.n_trials)
+                    except tf.errors.OpError:
+                        # E.g. no FFT kernels on the cpu before TF 1.2
+                        times[algorithm] = None
+                row = ['{:8.1f}'.format(1000.*times[a]) if times[a] is not None
+                       else '{:>8s}'.format('n/a') for a in algorithms]
+                timed = [a for a in algorithms if times[a] is not None]
+                print('{:6d} {:4d} {:9d} '.format(size, ksize, n_channels) +
+                      ' '.join(row) + '  ' + min(timed, key=times.get))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="comma separated image sizes", type=int_list, default=[32,64,128])
+    parser.add_argument("--ksizes", help="comma separated filter sizes", type=int_list, default=[3,5,9])
+    parser.add_argument("--channels", help="comma separated channel counts, in and out", type=int_list, default=[8,32])
+    parser.add_argument("--algorithms", help="comma separated algorithms", default='direct,fft,basis,gauss')
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--n_trials", help="number of timed runs per setting", type=int, default=5)
+    main(parser.parse_args())
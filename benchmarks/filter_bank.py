@@ -0,0 +1,117 @@
+'''Op count and step time of the stacked filter bank against the per-order
+construction it replaced'''
+
+import argparse
+import sys
+import time
+sys.path.append('../')
+
+import numpy as np
+import tensorflow as tf
+
+import harmonic_network_ops as hn
+
+
+# [batch,height,width,order,complex,channels], output channels and filter size
+# of layers of deep_mnist and hnet_bsd
+LAYERS = [('mnist 1', [46,28,28,1,1,1], 8, 5),
+          ('mnist 2', [46,28,28,2,2,8], 8, 5),
+          ('mnist 5', [46,7,7,2,2,32], 32, 5),
+          ('bsd 1', [2,161,241,1,1,3], 7, 5),
+          ('bsd 4', [2,20,30,2,2,56], 56, 5)]
+
+
+def legacy_filters(R, filter_size, P=None, n_rings=None):
+    """The filters of each order from two matmuls with its cosine and sine
+    bases and a phase rotation, as get_filters built them before
+    get_filter_stack"""
+    k = filter_size
+    filters = {}
+    for m, r in R.iteritems():
+        rsh = r.get_shape().as_list()
+        cosine, sine = hn.get_basis(k, m, n_rings=n_rings)
+        cosine = tf.constant(cosine)
+        sine = tf.constant(sine)
+        r = tf.reshape(r, tf.stack([rsh[0],rsh[1]*rsh[2]]))
+        ucos = tf.reshape(tf.matmul(cosine, r), tf.stack([k, k, rsh[1], rsh[2]]))
+        usin = tf.reshape(tf.matmul(sine, r), tf.stack([k, k, rsh[1], rsh[2]]))
+        if P is not None:
+            ucos_ = tf.cos(P[m])*ucos + tf.sin(P[m])*usin
+            usin = -tf.sin(P[m])*ucos + tf.cos(P[m])*usin
+            ucos = ucos_
+        filters[m] = (ucos, usin)
+    return filters
+
+
+def legacy_bank(W, n_orders, n_complex, max_order):
+    """The filter bank concatenated block by block, as h_conv built it before
+    get_filter_bank"""
+    W_ = []
+    for output_order in xrange(max_order+1):
+        Wr = []
+        Wi = []
+        for input_order in xrange(n_orders):
+            weight_order = output_order - input_order
+            weights = W[np.abs(weight_order)]
+            sign = np.sign(weight_order)
+            if n_complex == 2:
+                Wr += [weights[0],-sign*weights[1]]
+                Wi += [weights[1],sign*weights[0]]
+            else:
+                Wr += [weights[0]]
+                Wi += [weights[1]]
+        W_ += [tf.concat(axis=2, values=Wr), tf.concat(axis=2, values=Wi)]
+    return tf.concat(axis=3, values=W_)
+
+
+def measure(x_shape, n_channels, ksize, legacy, max_order=1, n_trials=5):
+    """Return the number of ops building the filter bank of a layer, the
+    number of ops of its forward and backward pass, and the fastest step
+    time in seconds"""
+    with tf.Graph().as_default() as graph:
+        x = tf.Variable(np.random.randn(*x_shape).astype(np.float32),
+                        trainable=False)
+        shape = [ksize, ksize, x_shape[5], n_channels]
+        Q = hn.get_weights_dict(shape, max_order, name='W')
+        P = hn.get_phase_dict(x_shape[5], n_channels, max_order, name='phase')
+        n_start = len(graph.get_operations())
+        if legacy:
+            W = legacy_bank(legacy_filters(Q, ksize, P=P), x_shape[3],
+                            x_shape[4], max_order)
+        else:
+            W = hn.get_filter_stack(Q, ksize, P=P)
+            W = hn.get_filter_bank(W, x_shape[3], x_shape[4], max_order)
+        n_filter_ops = len(graph.get_operations()) - n_start
+        # Both banks hold every stream, so the convolution is the same
+        X = tf.reshape(x, x_shape[:3]+[-1])
+        y = tf.nn.conv2d(X, W, strides=(1,1,1,1), padding='SAME')
+        grads = tf.gradients(tf.reduce_sum(y), [x,]+tf.trainable_variables())
+        n_ops = len(graph.get_operations()) - n_start
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(grads)
+            times = []
+            for i in xrange(n_trials):
+                start = time.time()
+                sess.run(grads)
+                times.append(time.time() - start)
+    return n_filter_ops, n_ops, min(times)
+
+
+def main(args):
+    print('{:>8s} {:>24s} {:>15s} {:>15s} {:>17s}'.format('layer', 'input',
+          'bank ops', 'fwd+bwd ops', 'step time (ms)'))
+    print('{:>8s} {:>24s} {:>15s} {:>15s} {:>17s}'.format('', '',
+          'legacy/stack', 'legacy/stack', 'legacy/stack'))
+    for name, x_shape, n_channels, ksize in LAYERS:
+        old = measure(x_shape, n_channels, ksize, True, n_trials=args.n_trials)
+        new = measure(x_shape, n_channels, ksize, False, n_trials=args.n_trials)
+        print('{:>8s} {:>24s} {:>7d}/{:<7d} {:>7d}/{:<7d} {:>8.1f}/{:<8.1f}'.format(
+              name, str(x_shape), old[0], new[0], old[1], new[1],
+              1000.*old[2], 1000.*new[2]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_trials", help="number of timed runs per layer", type=int, default=5)
+    main(parser.parse_args())
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import tempfile
 import time
 sys.path.append('../')
 
@@ -9,6 +10,7 @@ import numpy as np
 import tensorflow as tf
 
 import harmonic_network_lite as hl
+import harmonic_network_numpy as hn_np
 
 
 def test_forward_pass_shape():
@@ -74,6 +76,229 @@ def test_forward_invariance_90():
          assert np.amax(np.abs(Inv[j,:] - Inv[i,:])) < 1e-5
 
 
+def test_ring_quadrature():
+   """The per-ring quadrature matches the dense DFT of the ring basis"""
+   for k in xrange(3,22):
+      for m in xrange(4):
+         N = hl.n_samples(k)
+         weights = hl.get_interpolation_weights(k, m)
+         DFT = np.exp(-2j*np.pi*m*np.arange(N)/N)
+         dense = np.dot(DFT, weights)
+         quadrature = hl.get_ring_coefficients(k, m)
+         error = np.amax(np.abs(quadrature - dense)) / np.amax(np.abs(dense))
+         assert error < 1e-5, (k, m, error)
+
+
+def test_basis_conv():
+   """The basis-first convolution matches the direct convolution, for real
+   and complex inputs, with and without phase offsets"""
+   for n_orders, n_complex in ((1,1), (2,2)):
+      for phase in (True, False):
+         tf.reset_default_graph()
+         x = tf.placeholder(tf.float32, [3,9,9,n_orders,n_complex,4])
+         y = hl.conv2d(x, 5, 5, padding='SAME', phase=phase, name='conv_basis')
+         # The same weights and phases, executed basis-first
+         with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            y_basis = hl.conv2d(x, 5, 5, padding='SAME', phase=phase,
+                                algorithm='basis', name='conv_basis')
+
+         X = np.random.randn(3,9,9,n_orders,n_complex,4)
+
+         with tf.Session() as sess:
+            init_op = tf.global_variables_initializer()
+            sess.run(init_op)
+            Y, Y_basis = sess.run([y, y_basis], feed_dict={x: X})
+         assert Y.shape == Y_basis.shape
+         error = np.amax(np.abs(Y - Y_basis)) / np.amax(np.abs(Y))
+         assert error < 1e-5, (n_complex, phase, error)
+
+
+def test_fft_conv():
+   """The FFT convolution matches tf.nn.conv2d for SAME and VALID padding,
+   strides above 1 and odd and even sizes, and the 'fft' harmonic
+   convolution matches the direct one. Skipped where the device has no FFT
+   kernels, e.g. the cpu before TF 1.2."""
+   tf.reset_default_graph()
+   x = tf.placeholder(tf.float32, [2,None,None,3])
+   outputs = []
+   for ksize in (3, 4):
+      w = tf.constant(np.random.randn(ksize,ksize,3,5).astype(np.float32))
+      for padding in ('SAME', 'VALID'):
+         for stride in (1, 2, 3):
+            strides = (1,stride,stride,1)
+            outputs.append((tf.nn.conv2d(x, w, strides, padding),
+                            hl.fft_conv2d(x, w, strides, padding),
+                            (ksize, padding, stride)))
+   xh = tf.placeholder(tf.float32, [2,9,9,2,2,4])
+   y = hl.conv2d(xh, 5, 5, padding='SAME', strides=(1,2,2,1), name='conv_fft')
+   with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      y_fft = hl.conv2d(xh, 5, 5, padding='SAME', strides=(1,2,2,1),
+                        algorithm='fft', name='conv_fft')
+   outputs.append((y, y_fft, 'h_conv'))
+
+   with tf.Session() as sess:
+      feed_dict = {xh: np.random.randn(2,9,9,2,2,4)}
+      for size in ((10,10), (11,13)):
+         feed_dict[x] = np.random.randn(2,size[0],size[1],3)
+         try:
+            sess.run(tf.global_variables_initializer())
+            Y = sess.run([o[:2] for o in outputs], feed_dict=feed_dict)
+         except tf.errors.OpError:
+            return
+         for (y_direct, y_fft), (__, __, case) in zip(Y, outputs):
+            assert y_direct.shape == y_fft.shape, (size, case)
+            error = np.amax(np.abs(y_direct - y_fft)) / np.amax(np.abs(y_direct))
+            assert error < 1e-4, (size, case, error)
+
+
+def test_gauss_conv():
+   """Gauss' three-multiplication convolution matches the direct
+   convolution, for complex inputs of one and two orders, with and without
+   phase offsets"""
+   for n_orders in (1, 2):
+      for phase in (True, False):
+         tf.reset_default_graph()
+         x = tf.placeholder(tf.float32, [3,9,9,n_orders,2,4])
+         y = hl.conv2d(x, 5, 5, padding='SAME', phase=phase, name='conv_gauss')
+         # The same weights and phases, with three real products per complex
+         # product
+         with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            y_gauss = hl.conv2d(x, 5, 5, padding='SAME', phase=phase,
+                                algorithm='gauss', name='conv_gauss')
+
+         X = np.random.randn(3,9,9,n_orders,2,4)
+
+         with tf.Session() as sess:
+            init_op = tf.global_variables_initializer()
+            sess.run(init_op)
+            Y, Y_gauss = sess.run([y, y_gauss], feed_dict={x: X})
+         assert Y.shape == Y_gauss.shape
+         error = np.amax(np.abs(Y - Y_gauss)) / np.amax(np.abs(Y))
+         assert error < 1e-5, (n_orders, phase, error)
+
+
+def unfused_nonlin(X, fnc, scale, shift, eps):
+   """h_scaled_nonlin from plain tf ops, differentiated by tensorflow"""
+   R = tf.reduce_sum(tf.square(X), axis=[4], keep_dims=True)
+   r = tf.sqrt(tf.maximum(R, eps))
+   return fnc(scale*r + shift)*(X/r)
+
+
+def test_fused_nonlin_gradient():
+   """The analytic gradient of the fused nonlinearity matches tensorflow's
+   gradient of the unfused one, also for magnitudes at and below the clamp
+   at sqrt(eps), and the numerical gradient"""
+   tf.reset_default_graph()
+   eps = 1e-4
+   X = np.random.randn(2,5,5,2,2,3).astype(np.float32)
+   # Zero magnitudes, magnitudes below the clamp and just above it
+   X[0,0] = 0.
+   X[0,1] *= 0.5*np.sqrt(eps)/np.sqrt(np.sum(X[0,1]**2, axis=2, keepdims=True))
+   X[0,2] *= 2.*np.sqrt(eps)/np.sqrt(np.sum(X[0,2]**2, axis=2, keepdims=True))
+   x = tf.constant(X)
+   scale = tf.constant(np.random.rand(1,1,1,2,1,3).astype(np.float32) + 0.5)
+   shift = tf.constant(np.random.randn(1,1,1,2,1,3).astype(np.float32))
+   weights = tf.constant(np.random.randn(*X.shape).astype(np.float32))
+   y = hl.h_scaled_nonlin(x, tf.nn.relu, scale, shift, eps=eps)
+   y_ref = unfused_nonlin(x, tf.nn.relu, scale, shift, eps)
+   g = tf.gradients(tf.reduce_sum(weights*y), [x, scale, shift])
+   g_ref = tf.gradients(tf.reduce_sum(weights*y_ref), [x, scale, shift])
+
+   with tf.Session() as sess:
+      G, G_ref = sess.run([g, g_ref])
+   for name, a, b in zip(('x', 'scale', 'shift'), G, G_ref):
+      error = np.amax(np.abs(a - b)) / np.amax(np.abs(b))
+      assert error < 1e-5, (name, error)
+
+   # Numerically, on magnitudes away from the kinks of the clamp and relu.
+   # With eps=1e-2 the magnitudes of 0.03 are clamped.
+   tf.reset_default_graph()
+   eps = 1e-2
+   X = np.random.randn(1,3,3,2,2,2)
+   X *= 1./np.sqrt(np.sum(X**2, axis=4, keepdims=True))
+   X[:,0] *= 0.03
+   x = tf.constant(X.astype(np.float32))
+   y = hl.h_scaled_nonlin(x, tf.nn.relu, tf.ones([1,1,1,2,1,2]),
+                          tf.ones([1,1,1,2,1,2]), eps=eps)
+   with tf.Session():
+      error = tf.test.compute_gradient_error(x, X.shape, y, X.shape,
+                                             x_init_value=X.astype(np.float32))
+   assert error < 1e-2, error
+
+
+def test_checkpoint_gradient():
+   """The gradients through a checkpointed block, which recomputes it,
+   match those of the plain block, for the input and the variables, with
+   batch norm in training mode"""
+   tf.reset_default_graph()
+   x = tf.placeholder(tf.float32, [3,9,9,1,1,2])
+   train_phase = tf.placeholder(tf.bool)
+   def block(x):
+      y = hl.conv2d(x, 3, 3, padding='SAME', name='block_1')
+      y = hl.non_linearity(y, name='block_1')
+      y = hl.conv2d(y, 3, 3, padding='SAME', name='block_2')
+      return hl.batch_norm(y, train_phase, name='bn_block')
+   # Batch norm keeps its moving averages outside get_variable, so the
+   # checkpointed block gets a copy of the variables instead of sharing them
+   with tf.variable_scope('plain'):
+      y = block(x)
+   with tf.variable_scope('checkpointed'):
+      y_checkpoint = hl.checkpoint(block, x, name='block')
+   variables = [v for v in tf.trainable_variables()
+                if v.op.name.startswith('plain/')]
+   copies = [v for v in tf.trainable_variables()
+             if v.op.name.startswith('checkpointed/')]
+   copy_op = tf.group(*[tf.assign(c, v) for v, c in zip(variables, copies)])
+   weights = tf.constant(np.random.randn(3,9,9,2,2,3).astype(np.float32))
+   g = tf.gradients(tf.reduce_sum(weights*y), [x,]+variables)
+   g_checkpoint = tf.gradients(tf.reduce_sum(weights*y_checkpoint),
+                               [x,]+copies)
+
+   X = np.random.randn(3,9,9,1,1,2)
+
+   with tf.Session() as sess:
+      init_op = tf.global_variables_initializer()
+      sess.run(init_op)
+      sess.run(copy_op)
+      G, G_checkpoint = sess.run([g, g_checkpoint],
+                                 feed_dict={x: X, train_phase: True})
+   assert len(variables) == len(copies) > 0
+   for v, a, b in zip(['x',]+[v.op.name for v in variables], G, G_checkpoint):
+      error = np.amax(np.abs(a - b)) / np.maximum(np.amax(np.abs(a)), 1e-12)
+      assert error < 1e-4, (v, error)
+
+
+def test_real_order0():
+   """With a real order 0 filter on a real input, the imaginary order 0
+   stream is zero, and the exported filter bank leaves it out, so that
+   harmonic_network_numpy only computes the other streams"""
+   tf.reset_default_graph()
+   x = tf.placeholder(tf.float32, [3,9,9,1,1,4])
+   y = hl.conv2d(x, 5, 5, padding='SAME', real_order0=True, name='conv_real')
+
+   X = np.random.randn(3,9,9,1,1,4)
+
+   with tf.Session() as sess:
+      init_op = tf.global_variables_initializer()
+      sess.run(init_op)
+      Y = sess.run(y, feed_dict={x: X})
+      params = hl.export(sess, os.path.join(tempfile.mkdtemp(), 'real.npz'))
+   assert np.all(Y[:,:,:,0,1] == 0.)
+   # Three of the four output streams
+   assert list(params['conv_real_cols']) == [0,2,3], params['conv_real_cols']
+   assert params['conv_real'].shape == (5,5,4,3*5), params['conv_real'].shape
+   Y_numpy = hn_np.conv2d(X.astype(np.float32), params, padding='SAME',
+                          name='conv_real')
+   error = np.amax(np.abs(Y - Y_numpy)) / np.amax(np.abs(Y))
+   assert error < 1e-5, error
+
 test_forward_pass_shape()
 test_backward_pass_shape()
 test_forward_invariance_90()
+test_ring_quadrature()
+test_basis_conv()
+test_fft_conv()
+test_gauss_conv()
+test_fused_nonlin_gradient()
+test_checkpoint_gradient()
+test_real_order0()
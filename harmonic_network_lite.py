@@ -4,15 +4,30 @@ Harmonic Convolutions Lite
 A simplified API for harmomin_network_ops
 """
 
+import json
+import os
+import time
+import weakref
+from contextlib import contextmanager
+
 import numpy as np
 import tensorflow as tf
 
+from tensorflow.python.framework import function
+
 from harmonic_network_ops import *
 
 
 def conv2d(x, n_channels, ksize, strides=(1,1,1,1), padding='VALID', phase=True,
-             max_order=1, stddev=0.4, n_rings=None, name='conv2d'):
-    """Harmonic Convolution lite
+             max_order=1, stddev=0.4, n_rings=None, basis_type='dft',
+             algorithm='direct', real_order0=False, name='conv2d'):
+    """Harmonic Convolution lite. Within frozen(), the layer is built from
+    precomputed filters instead of weights and phases, and within
+    filter_cache() it keeps its filters in a buffer between weight updates.
+    The layer computes in the dtype of x, e.g. float16 for reduced precision,
+    while the weights stay float32. The convolutions then also accumulate in
+    that dtype, e.g. in half precision on the cpu; only the weights, batch
+    norm statistics and magnitude reductions are kept in float32.
 
     x: input tf tensor, shape [batchsize,height,width,order,complex,channels],
     e.g. a real input tensor of rotation order 0 could have shape
@@ -25,30 +40,116 @@ def conv2d(x, n_channels, ksize, strides=(1,1,1,1), padding='VALID', phase=True,
     phase: use a per-channel phase offset (default True)
     max_order: maximum rotation order e.g. max_order=2 uses 0,1,2 (default 1)
     stddev: scale of filter initialization wrt He initialization
+    n_rings: number of rings in the filter basis (default max(ksize/2, 2))
+    basis_type: 'dft' samples each ring densely, 'quadrature' builds the same
+    basis from a short per-ring quadrature (default 'dft')
+    algorithm: 'direct' spatial convolution, 'fft' convolution in the
+    frequency domain, 'basis' to convolve with the fixed ring basis and
+    mix the responses, which is cheaper for many output channels, 'gauss'
+    to use three real convolutions per complex product, or 'auto' to time
+    them on first use and pick the fastest, see autotune (default 'direct')
+    real_order0: keep the order 0 filter real, without a phase offset even
+    with phase. On a real input, e.g. in a first layer, its imaginary output
+    stream is then zero. Tensorflow still computes it, but it is left out of
+    the filter bank from export, so harmonic_network_numpy does not
+    (default False)
     name: (default 'lconv')
     device: (default '/cpu:0')
     """
     xsh = x.get_shape().as_list()
-    shape = [ksize, ksize, xsh[5], n_channels]
-    Q = get_weights_dict(shape, max_order, std_mult=stddev, n_rings=n_rings, name='W'+name)
-    if phase == True:
-        P = get_phase_dict(xsh[5], n_channels, max_order, name='phase'+name)
+    real_order0 = real_order0 or (phase != True)
+    if _FROZEN['params'] is not None:
+        # Bake in the filters, the algorithm is given by their layout
+        filters = tf.constant(_FROZEN['params'][name], name='filters'+name)
+        ndims = filters.get_shape().ndims
+        if ndims == 2:
+            algorithm = 'basis'
+        elif ndims == 6:
+            algorithm = 'gauss'
+        elif algorithm != 'fft':
+            algorithm = 'direct'
+    else:
+        if algorithm == 'auto':
+            algorithm = autotune(representative_shape(x, name), n_channels,
+                                 ksize, strides=strides,
+                                 padding=padding, phase=phase,
+                                 max_order=max_order, n_rings=n_rings,
+                                 basis_type=basis_type, dtype=x.dtype)
+        shape = [ksize, ksize, xsh[5], n_channels]
+        Q = get_weights_dict(shape, max_order, std_mult=stddev, n_rings=n_rings, name='W'+name)
+        if phase == True:
+            P = get_phase_dict(xsh[5], n_channels, max_order,
+                               real_order0=real_order0, name='phase'+name)
+        else:
+            P = None
+        def build():
+            if algorithm == 'basis':
+                return get_basis_mixing(Q, xsh[3], xsh[4], max_order, P=P)
+            W = get_filter_stack(Q, filter_size=ksize, P=P, n_rings=n_rings,
+                                 basis_type=basis_type)
+            if algorithm == 'gauss':
+                return W
+            return get_filter_bank(W, xsh[3], xsh[4], max_order)
+        if _RECOMPUTE['active']:
+            # Recomputing a checkpointed block for its gradients
+            filters = build()
+        elif _FILTER_CACHE['use_cache'] is not None:
+            filters = cache_filters(build, _FILTER_CACHE['use_cache'], name)
+            _LAYER_PARAMS.setdefault(x.graph, {})[name] = filters
+        else:
+            filters = build()
+            _LAYER_PARAMS.setdefault(x.graph, {})[name] = filters
+        if not _RECOMPUTE['active']:
+            _LAYER_SHAPES.setdefault(x.graph, {})[name] = xsh
+            _LAYER_LAYOUTS.setdefault(x.graph, {})[name] = {
+                'algorithm': algorithm, 'n_orders': xsh[3],
+                'n_complex': xsh[4], 'n_channels': xsh[5],
+                'max_order': max_order, 'real_order0': real_order0,
+                'ksize': ksize, 'n_rings': n_rings, 'basis_type': basis_type}
+    filters = tf.cast(filters, x.dtype)
+    if algorithm == 'basis':
+        R = h_basis_conv(x, filters, ksize, strides=strides, padding=padding,
+                         max_order=max_order, n_rings=n_rings,
+                         basis_type=basis_type, name=name)
     else:
-        P = None
-    W = get_filters(Q, filter_size=ksize, P=P, n_rings=n_rings)
-    R = h_conv(x, W, strides=strides, padding=padding, max_order=max_order,
-               name=name)
+        R = h_conv(x, filters, strides=strides, padding=padding,
+                   max_order=max_order, algorithm=algorithm, name=name)
     return R
 
 
 def batch_norm(x, train_phase, fnc=tf.nn.relu, decay=0.99, eps=1e-4, name='hbn'):
-    """Batch normalization for the magnitudes of X"""
-    return h_batch_norm(x, fnc, train_phase, decay=decay, eps=eps, name=name)
+    """Batch normalization for the magnitudes of X. Within frozen(), the
+    population statistics are folded into a per-channel scale and shift, and
+    within quantized(), the output is quantized. With train_phase None, the
+    layer is an inference copy of an existing batch_norm of the same name,
+    e.g. built with reuse=True, which applies its folded population
+    statistics without a tf.cond."""
+    if _FROZEN['params'] is not None:
+        scale = tf.constant(_FROZEN['params'][name+'_scale'])
+        shift = tf.constant(_FROZEN['params'][name+'_shift'])
+        y = h_scaled_nonlin(x, fnc, scale, shift, eps=eps, name=name)
+        return layer_output(y, name)
+    if train_phase is None:
+        scale, shift = fold_batch_norm(name)
+        return h_scaled_nonlin(x, fnc, scale, shift, eps=eps, name=name)
+    y = h_batch_norm(x, fnc, train_phase, decay=decay, eps=eps,
+                     update_stats=not _RECOMPUTE['active'], name=name)
+    if _RECOMPUTE['active']:
+        return y
+    scale, shift = fold_batch_norm(name)
+    params = _LAYER_PARAMS.setdefault(x.graph, {})
+    params[name+'_scale'] = scale
+    params[name+'_shift'] = shift
+    return layer_output(y, name)
 
 
 def non_linearity(x, fnc=tf.nn.relu, eps=1e-4, name='nl'):
-    """Alter nonlinearity for the complex domains"""
-    return h_nonlin(x, fnc, eps=eps, name=name)
+    """Alter nonlinearity for the complex domains. Within quantized(), the
+    output is quantized."""
+    y = h_nonlin(x, fnc, eps=eps, name=name)
+    if _RECOMPUTE['active']:
+        return y
+    return layer_output(y, name)
 
 
 def mean_pool(x, ksize=(1,1,1,1), strides=(1,1,1,1), name='mp'):
@@ -60,7 +161,7 @@ def mean_pool(x, ksize=(1,1,1,1), strides=(1,1,1,1), name='mp'):
 def sum_magnitudes(x, eps=1e-12, keep_dims=True):
     """Sum the magnitudes of each of the complex feature maps in X.
 
-    Output U = sum_i |x_i|
+    Output U = sum_i |x_i|, accumulated and returned in float32
 
     x: input tf tensor, shape [batchsize,height,width,channels,complex,order],
     e.g. a real input tensor of rotation order 0 could have shape
@@ -69,17 +170,588 @@ def sum_magnitudes(x, eps=1e-12, keep_dims=True):
     eps: regularization since grad |x| is infinite at zero (default 1e-4)
     keep_dims: whether to collapse summed dimensions (default True)
     """
-    R = tf.reduce_sum(tf.square(x), axis=[4], keep_dims=keep_dims)
+    R = tf.reduce_sum(tf.square(tf.cast(x, tf.float32)), axis=[4], keep_dims=keep_dims)
     return tf.reduce_sum(tf.sqrt(tf.maximum(R,eps)), axis=[3], keep_dims=keep_dims)
 
 
 def stack_magnitudes(X, eps=1e-12, keep_dims=True):
     """Stack the magnitudes of each of the complex feature maps in X.
 
-    Output U = concat(|X_i|)
+    Output U = concat(|X_i|), accumulated and returned in float32
 
     X: dict of channels {rotation order: (real, imaginary)}
     eps: regularization since grad |Z| is infinite at zero (default 1e-12)
     """
-    R = tf.reduce_sum(tf.square(X), axis=[4], keep_dims=keep_dims)
+    R = tf.reduce_sum(tf.square(tf.cast(X, tf.float32)), axis=[4], keep_dims=keep_dims)
     return tf.sqrt(tf.maximum(R,eps))
+
+
+def rotation_error(predict, X, axes=(1,2), output_axes=None):
+    """Return the largest change of a model output under the 90 degree
+    rotations of its input, relative to the largest output. Rotations by 90
+    degrees are exact on the pixel grid, so for an invariant model this
+    measures the numerical error, e.g. of reduced precision.
+
+    predict: function mapping a batch like X to a numpy array
+    X: numpy batch of input images
+    axes: spatial axes of X (default (1,2))
+    output_axes: spatial axes of the output, which are rotated back before
+    comparing, or None for invariant outputs such as logits (default None)
+    """
+    Y = predict(X)
+    error = 0.
+    for k in xrange(1,4):
+        Yk = predict(rot90(X, k, axes))
+        if output_axes is not None:
+            Yk = rot90(Yk, 4-k, output_axes)
+        error = max(error, np.amax(np.abs(Yk - Y)))
+    return error / np.maximum(np.amax(np.abs(Y)), 1e-12)
+
+
+def rot90(X, k=1, axes=(1,2)):
+    """Rotate the numpy array X by k*90 degrees in the plane of axes"""
+    flip = (slice(None),)*axes[1] + (slice(None,None,-1),)
+    for i in xrange(k % 4):
+        X = np.swapaxes(X, axes[0], axes[1])[flip]
+    return X
+
+
+##### AUTOTUNING #####
+ALGORITHMS = ('direct', 'fft', 'basis', 'gauss')
+_AUTOTUNE = {'cache_file': os.environ.get('HNET_AUTOTUNE_CACHE',
+                 os.path.join(os.path.expanduser('~'), '.hnet_autotune.json')),
+             'decisions': None, 'config': None, 'has_gpu': None}
+
+
+def set_autotune_cache(cache_file):
+    """Set the file in which autotuning decisions are stored (default
+    $HNET_AUTOTUNE_CACHE or ~/.hnet_autotune.json)"""
+    _AUTOTUNE['cache_file'] = cache_file
+    _AUTOTUNE['decisions'] = None
+
+
+def set_autotune_config(config):
+    """Set the tf.ConfigProto of the sessions in which conv2d layers are
+    autotuned, e.g. the one used for training, so that they are timed with the
+    same device settings (default None, the tensorflow defaults)"""
+    _AUTOTUNE['config'] = config
+    _AUTOTUNE['has_gpu'] = None
+
+
+def autotune(x_shape, n_channels, ksize, strides=(1,1,1,1), padding='VALID',
+             phase=True, max_order=1, n_rings=None, basis_type='dft',
+             dtype=tf.float32, algorithms=None,
+             n_trials=5, max_slowdown=10.):
+    """Return the fastest conv2d algorithm for a layer. Each candidate is timed
+    for a forward and backward pass in a throwaway graph, the first time a
+    layer signature is seen, in sessions configured by set_autotune_config.
+    Candidates which fail to run on the device are skipped, and so are those
+    whose first run takes longer than max_slowdown times the best time so
+    far, which would otherwise take minutes on large images. Decisions are
+    stored in the autotune cache file and reused by later runs. Layers of
+    unknown image size are 'direct', unless conv2d finds their size within
+    representative().
+
+    x_shape: input shape [batchsize,height,width,order,complex,channels]
+    n_channels, ksize, strides, padding, phase, max_order, n_rings,
+    basis_type: as for conv2d
+    dtype: dtype of the input, in which the layer computes (default float32)
+    algorithms: candidates (default ALGORITHMS, without 'fft' unless there
+    is a gpu, since the cpu FFT kernels are orders of magnitude slower)
+    n_trials: number of timed runs per candidate (default 5)
+    max_slowdown: time limit of the first run of a candidate, relative to the
+    best time so far (default 10.)
+    """
+    if x_shape[0] is None:
+        # A dynamic batch size is timed with a typical batch
+        x_shape = [16,] + list(x_shape[1:])
+    if None in x_shape:
+        # We can only time fully defined images
+        return 'direct'
+    if algorithms is None:
+        algorithms = [a for a in ALGORITHMS if a != 'fft' or has_gpu()]
+    if x_shape[4] == 1:
+        # Gauss' trick only applies to complex inputs
+        algorithms = [a for a in algorithms if a != 'gauss']
+    dtype = tf.as_dtype(dtype)
+    signature = json.dumps([list(x_shape), n_channels, ksize, list(strides),
+                            padding, phase, max_order, n_rings, basis_type,
+                            dtype.name, sorted(algorithms)])
+    decisions = load_autotune_cache()
+    if signature not in decisions:
+        times = {}
+        for algorithm in algorithms:
+            max_time = None
+            if times:
+                max_time = max_slowdown*min(times.values())
+            try:
+                times[algorithm] = time_conv2d(x_shape, n_channels, ksize,
+                                    strides=strides, padding=padding,
+                                    phase=phase, max_order=max_order,
+                                    n_rings=n_rings, basis_type=basis_type,
+                                    dtype=dtype, algorithm=algorithm,
+                                    n_trials=n_trials, max_time=max_time,
+                                    config=_AUTOTUNE['config'])
+            except tf.errors.DeadlineExceededError:
+                # Far slower than the best candidate
+                continue
+            except tf.errors.OpError:
+                # The device has no kernels for it, e.g. no FFT on the cpu
+                # before TF 1.2
+                continue
+        best = min(times, key=times.get)
+        print('Autotuned conv2d {:s} {:s}: {:s} {}'.format(str(x_shape),
+              dtype.name, best, times))
+        decisions[signature] = {'algorithm': best, 'times': times}
+        save_autotune_cache()
+    return decisions[signature]['algorithm']
+
+
+def has_gpu():
+    """Return whether the sessions configured by set_autotune_config have a
+    gpu, found by placing an op there"""
+    if _AUTOTUNE['has_gpu'] is None:
+        config = tf.ConfigProto()
+        if _AUTOTUNE['config'] is not None:
+            config.CopyFrom(_AUTOTUNE['config'])
+        config.allow_soft_placement = False
+        with tf.Graph().as_default():
+            with tf.device('/gpu:0'):
+                x = tf.identity(tf.zeros([1]))
+            with tf.Session(config=config) as sess:
+                try:
+                    sess.run(x)
+                    _AUTOTUNE['has_gpu'] = True
+                except tf.errors.InvalidArgumentError:
+                    _AUTOTUNE['has_gpu'] = False
+    return _AUTOTUNE['has_gpu']
+
+
+def time_conv2d(x_shape, n_channels, ksize, algorithm='direct', n_trials=5,
+                dtype=tf.float32, max_time=None, config=None, **kwargs):
+    """Return the fastest of n_trials forward and backward passes of a conv2d
+    layer in seconds, measured in a separate graph and session, on an input
+    of the given dtype. Raises tf.errors.DeadlineExceededError if the first,
+    untimed pass takes longer than max_time seconds.
+
+    config: tf.ConfigProto of the session (default None)
+    """
+    dtype = tf.as_dtype(dtype)
+    options = None
+    if max_time is not None:
+        options = tf.RunOptions(timeout_in_ms=max(int(1000*max_time), 1))
+    with tf.Graph().as_default():
+        # Use a variable input, so that nothing is constant-folded
+        x = tf.Variable(np.random.randn(*x_shape).astype(dtype.as_numpy_dtype),
+                        trainable=False)
+        with filter_cache(None):
+            y = conv2d(x, n_channels, ksize, algorithm=algorithm,
+                       name='autotune', **kwargs)
+        grads = tf.gradients(tf.reduce_sum(y), [x,]+tf.trainable_variables())
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            start = time.time()
+            sess.run(grads, options=options)
+            if max_time is not None and time.time() - start > max_time:
+                # Ops which cannot be cancelled may outlast the deadline
+                raise tf.errors.DeadlineExceededError(None, None,
+                    'conv2d {:s} exceeded {:.3f}s'.format(algorithm, max_time))
+            times = []
+            for i in xrange(n_trials):
+                start = time.time()
+                sess.run(grads)
+                times.append(time.time() - start)
+    return min(times)
+
+
+def load_autotune_cache():
+    """Return the dict of autotuning decisions, read from the cache file"""
+    if _AUTOTUNE['decisions'] is None:
+        _AUTOTUNE['decisions'] = {}
+        if os.path.exists(_AUTOTUNE['cache_file']):
+            with open(_AUTOTUNE['cache_file']) as fp:
+                _AUTOTUNE['decisions'] = json.load(fp)
+    return _AUTOTUNE['decisions']
+
+
+def save_autotune_cache():
+    """Write the autotuning decisions to the cache file"""
+    tmp_file = _AUTOTUNE['cache_file'] + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        json.dump(_AUTOTUNE['decisions'], fp, indent=1, sort_keys=True)
+    os.rename(tmp_file, _AUTOTUNE['cache_file'])
+
+
+##### REPRESENTATIVE SHAPES #####
+# The input shapes of the conv2d layers of each graph, and the graph of the
+# same model on inputs of a typical, fully defined shape
+_LAYER_SHAPES = weakref.WeakKeyDictionary()
+_REPRESENTATIVE = {'graph': None}
+
+
+@contextmanager
+def representative(graph):
+    """Context in which conv2d layers and checkpointed blocks of partly
+    unknown shape, e.g. on placeholders of any image size, are autotuned and
+    sized like their namesakes in graph. Build the model there first, on
+    inputs of a typical shape, e.g. a batch of 321x481 BSD images.
+
+    graph: tf graph of the model on inputs of fully defined shape
+    """
+    previous = _REPRESENTATIVE['graph']
+    _REPRESENTATIVE['graph'] = graph
+    try:
+        yield
+    finally:
+        _REPRESENTATIVE['graph'] = previous
+
+
+def representative_shape(x, name):
+    """Return the shape of x, the input of the conv2d layer name, with its
+    unknown dimensions taken from the namesake of the layer in the
+    representative graph, where there is one"""
+    xsh = x.get_shape().as_list()
+    graph = _REPRESENTATIVE['graph']
+    if None in xsh and graph is not None:
+        shape = _LAYER_SHAPES.get(graph, {}).get(name, xsh)
+        xsh = [s if d is None else d for d, s in zip(xsh, shape)]
+    return xsh
+
+
+##### FROZEN FILTERS #####
+# The filters of every conv2d layer and the folded scales and shifts of every
+# batch_norm layer, per graph, and the parameters to bake in
+_LAYER_PARAMS = weakref.WeakKeyDictionary()
+_LAYER_LAYOUTS = weakref.WeakKeyDictionary()
+_FROZEN = {'params': None}
+
+
+def freeze(sess, feed_dict=None):
+    """Evaluate the filters of all conv2d layers and the folded batch norms
+    of all batch_norm layers in the graph of a session. Returns a dict
+    {layer name: filters}, where the filters are the assembled filter banks,
+    filter stacks for 'gauss' layers, or mixing matrices for 'basis' layers,
+    and {name_scale, name_shift: array} for each batch_norm layer. Save it
+    with np.savez and rebuild the model within frozen() for inference.
+
+    sess: tf session holding the trained weights
+    feed_dict: feeds needed by the filters, e.g. the use_cache condition of
+    filter_cache (default None)
+    """
+    layers = _LAYER_PARAMS.get(sess.graph, {})
+    names = sorted(layers.keys())
+    values = sess.run([layers[n] for n in names], feed_dict=feed_dict)
+    return dict(zip(names, values))
+
+
+@contextmanager
+def frozen(params):
+    """Context in which conv2d builds layers from precomputed filters, as
+    returned by freeze, instead of weights and phases, and batch_norm applies
+    the folded population statistics with h_scaled_nonlin. These become
+    constants, so the inference graph only holds the convolutions and one
+    magnitude rescaling per batch norm. Restore the remaining variables
+    (biases) with restore_variables.
+
+    params: dict from freeze
+    """
+    previous = _FROZEN['params']
+    _FROZEN['params'] = params
+    try:
+        yield
+    finally:
+        _FROZEN['params'] = previous
+
+
+def export(sess, filename, feed_dict=None, config=None):
+    """Save what harmonic_network_numpy needs to run the model of a session
+    without tensorflow to the npz file filename, and return it as a dict.
+    This holds the filters of every conv2d layer as a filter bank without
+    its zero streams, see to_filter_bank, whatever its algorithm, with the
+    input and output streams of the bank under name_rows and name_cols, the
+    folded batch norms from freeze, and the values of all trainable
+    variables, e.g. the biases.
+
+    sess: tf session holding the trained weights
+    filename: path of the npz file
+    feed_dict: feeds needed by the filters, as for freeze (default None)
+    config: tf.ConfigProto of the session converting the filters, e.g. that
+    of sess (default None)
+    """
+    params = freeze(sess, feed_dict=feed_dict)
+    variables = sess.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+    arrays = dict(zip([v.op.name for v in variables], sess.run(variables)))
+    layouts = _LAYER_LAYOUTS.get(sess.graph, {})
+    # Convert the filters in a scratch graph, so that the graph of the session
+    # stays as it is
+    with tf.Graph().as_default():
+        with tf.Session(config=config) as scratch:
+            for name, value in params.items():
+                if name not in layouts:
+                    arrays[name] = value
+                    continue
+                bank, rows, cols = to_filter_bank(scratch, value,
+                                                  **layouts[name])
+                arrays[name] = bank
+                arrays[name+'_rows'] = np.asarray(rows, dtype=np.int32)
+                arrays[name+'_cols'] = np.asarray(cols, dtype=np.int32)
+    np.savez(filename, **arrays)
+    return arrays
+
+
+def to_filter_bank(sess, filters, algorithm, n_orders, n_complex, n_channels,
+                   max_order, real_order0, ksize, n_rings, basis_type):
+    """Convert the filters of a conv2d layer, as returned by freeze, into a
+    filter bank as from get_filter_bank, without the input and output streams
+    which only meet zero filters. Returns the bank and the streams it holds,
+    see nonzero_blocks.
+
+    sess: tf session of the default graph, used to assemble the bank
+    filters: numpy filters of the layer
+    the other arguments describe the layer, as recorded by conv2d
+    """
+    index, sign = filter_bank_indices(n_orders, n_complex, max_order,
+                                      real_order0=real_order0)
+    rows, cols = nonzero_blocks(sign)
+    if filters.ndim == 6:
+        filters = sess.run(get_filter_bank(tf.constant(filters), n_orders,
+                                           n_complex, max_order))
+    elif filters.ndim == 2:
+        # Mix the ring basis into full filters
+        if n_rings is None:
+            n_rings = np.maximum(ksize/2, 2)
+        n_in = n_orders*n_complex*n_channels
+        n_basis = filters.shape[0] // n_in
+        n_weight_orders = (n_basis // n_rings + 1) // 2
+        basis = sess.run(get_depthwise_basis_constant(ksize, n_weight_orders,
+                             1, n_rings=n_rings, basis_type=basis_type))
+        M = np.reshape(filters, [n_in, n_basis, -1])
+        filters = np.einsum('hwb,ibo->hwio', basis[:,:,0,:], M)
+    # Leave out the zero streams
+    bank = np.reshape(filters, [ksize, ksize, n_orders*n_complex, n_channels,
+                                2*(max_order+1), -1])
+    bank = bank[:,:,rows][:,:,:,:,cols]
+    filters = np.reshape(bank, [ksize, ksize, len(rows)*n_channels, -1])
+    return filters, rows, cols
+
+
+##### FILTER CACHE #####
+# The condition for using cached filters, and the validity flags of the
+# cached filters, per graph
+_FILTER_CACHE = {'use_cache': None}
+_CACHE_FLAGS = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def filter_cache(use_cache):
+    """Context in which conv2d keeps its filters in non-trainable buffers.
+    Whenever use_cache is true, e.g. during validation, a layer reuses its
+    buffer and only rebuilds the filters in the first run after
+    invalidate_filter_cache. Otherwise the filters are built as usual.
+
+    use_cache: scalar bool tensor, e.g. tf.logical_not(train_phase)
+    """
+    previous = _FILTER_CACHE['use_cache']
+    _FILTER_CACHE['use_cache'] = use_cache
+    try:
+        yield
+    finally:
+        _FILTER_CACHE['use_cache'] = previous
+
+
+def cache_filters(build, use_cache, name='cache'):
+    """Return the filters made by build, or if use_cache is true, the filters
+    stored in a buffer, which is refreshed when it is stale
+
+    build: function returning the filters
+    use_cache: scalar bool tensor
+    name: (default 'cache')
+    """
+    with tf.name_scope('filter_cache'+name) as scope:
+        # The buffer takes its shape from the first refresh
+        buffer = tf.Variable(tf.zeros([0]), trainable=False,
+                             collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                             validate_shape=False, name='buffer')
+        valid = tf.Variable(False, trainable=False,
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                            name='valid')
+        _CACHE_FLAGS.setdefault(valid.graph, []).append(valid)
+
+        def refresh():
+            filters = build()
+            store = tf.assign(buffer, filters, validate_shape=False)
+            with tf.control_dependencies([store, tf.assign(valid, True)]):
+                return tf.identity(filters)
+        built = []
+        def rebuild():
+            built.append(build())
+            return built[0]
+        # Branch on a copy of the flag. A read of the variable shares its
+        # memory, so refresh setting the flag would also switch the branch.
+        is_valid = tf.logical_and(valid, True)
+        filters = tf.cond(use_cache,
+                          lambda: tf.cond(is_valid, lambda: tf.identity(buffer),
+                                          refresh),
+                          rebuild)
+        filters.set_shape(built[0].get_shape())
+        return filters
+
+
+def invalidate_filter_cache(train_op=None):
+    """Return an op marking the cached filters of the default graph as stale,
+    so that they are rebuilt at their next use. Given a train_op, the
+    returned op first runs it, so use it in place of the train_op.
+
+    train_op: op updating the weights (default None)
+    """
+    flags = _CACHE_FLAGS.get(tf.get_default_graph(), [])
+    dependencies = [] if train_op is None else [train_op]
+    with tf.control_dependencies(dependencies):
+        return tf.group(*[tf.assign(valid, False) for valid in flags])
+
+
+##### GRADIENT CHECKPOINTING #####
+# Whether a checkpointed block is being recomputed, and the checkpointed
+# blocks of each graph
+_RECOMPUTE = {'active': False}
+_CHECKPOINTS = weakref.WeakKeyDictionary()
+
+
+def checkpoint(block, x, name='checkpoint'):
+    """Apply block to x, without keeping the activations inside the block for
+    the backward pass. The gradient recomputes the block from x instead, so
+    only the block boundaries stay in memory, at the cost of one more forward
+    pass of the block. The block must build its variables with get_variable,
+    like conv2d, non_linearity and batch_norm do. Batch norm statistics are
+    only updated by the first forward pass.
+
+    block: function mapping a tensor to a tensor
+    x: input tensor
+    name: (default 'checkpoint')
+    """
+    graph = x.graph
+    scope = tf.get_variable_scope()
+    n_ops = len(graph.get_operations())
+    y = block(tf.stop_gradient(x))
+    # Find the trainable variables read by the block
+    trainable = dict([(v.op, v) for v in tf.trainable_variables()])
+    variables = []
+    n_elements = 0
+    for op in graph.get_operations()[n_ops:]:
+        for t in op.inputs:
+            if t.op in trainable and trainable[t.op] not in variables:
+                variables.append(trainable[t.op])
+        for t in op.outputs:
+            shape = t.get_shape()
+            if (t.dtype.is_floating and shape.ndims >= 4 and
+                n_elements is not None):
+                if shape.is_fully_defined():
+                    n_elements += shape.num_elements()
+                else:
+                    n_elements = None
+    n_boundary = None
+    if x.get_shape().is_fully_defined() and y.get_shape().is_fully_defined():
+        n_boundary = x.get_shape().num_elements() + y.get_shape().num_elements()
+    if n_elements is None and _REPRESENTATIVE['graph'] is not None:
+        # Count the elements of the namesake in the representative graph
+        for info in _CHECKPOINTS.get(_REPRESENTATIVE['graph'], []):
+            if info['name'] == name:
+                n_elements = info['activations']
+                n_boundary = info['boundary']
+    checkpoints = _CHECKPOINTS.setdefault(graph, [])
+    checkpoints.append({'name': name, 'activations': n_elements,
+                        'boundary': n_boundary})
+
+    def grad(op, dy):
+        # Only recompute once the gradient of the block arrives. Otherwise
+        # the recomputation has all its inputs during the forward pass, runs
+        # there, and its activations are kept until backprop reaches them.
+        with tf.control_dependencies([dy]):
+            x_ = tf.identity(op.inputs[1])
+        _RECOMPUTE['active'] = True
+        try:
+            with tf.variable_scope(scope, reuse=True):
+                y_ = block(x_)
+        finally:
+            _RECOMPUTE['active'] = False
+        grads = tf.gradients(y_, [x_,] + variables, grad_ys=dy)
+        dv = []
+        for g, var in zip(grads[1:], variables):
+            if g is None:
+                g = tf.zeros_like(var)
+            dv.append(tf.reshape(tf.convert_to_tensor(g), [-1]))
+        dv = tf.concat(axis=0, values=[tf.zeros([0]),] + dv)
+        return None, grads[0], dv
+
+    # Route the gradients of the output to the input and the variables
+    # through one function call, whose gradient is the recomputation
+    @function.Defun(y.dtype, x.dtype, tf.float32, python_grad_func=grad,
+                    func_name='Checkpoint{:d}'.format(len(checkpoints)))
+    def boundary(y, x, v):
+        return tf.identity(y)
+    v = [tf.reshape(var, [-1]) for var in variables]
+    v = tf.concat(axis=0, values=[tf.zeros([0]),] + v)
+    z = boundary(y, x, v)
+    z.set_shape(y.get_shape())
+    return z
+
+
+def checkpoint_info(graph=None):
+    """Return a list of the checkpointed blocks of a graph, each a dict with
+    the number of activation elements the backward pass no longer keeps
+    (approximately, the float outputs of rank >= 4 built in the block) and
+    the number of elements in its boundaries, which are kept. The counts are
+    None for blocks of unknown shape, e.g. with a dynamic batch size, unless
+    they are built within representative().
+
+    graph: (default the default graph)
+    """
+    if graph is None:
+        graph = tf.get_default_graph()
+    return list(_CHECKPOINTS.get(graph, []))
+
+
+##### QUANTIZATION #####
+# The outputs of every non_linearity and batch_norm layer, per graph, and the
+# calibrated magnitude ranges with which to quantize them
+_LAYER_OUTPUTS = weakref.WeakKeyDictionary()
+_QUANTIZE = {'ranges': None, 'n_bits': 8}
+
+
+def layer_output(y, name):
+    """Record the output of a non_linearity or batch_norm layer, see
+    layer_outputs, and quantize it within quantized()"""
+    _LAYER_OUTPUTS.setdefault(y.graph, {})[name] = y
+    if _QUANTIZE['ranges'] is None:
+        return y
+    return quantize_polar(y, _QUANTIZE['ranges'][name],
+                          n_bits=_QUANTIZE['n_bits'])
+
+
+def layer_outputs(graph=None):
+    """Return the dict {layer name: output} of the non_linearity and
+    batch_norm layers of a graph, e.g. to calibrate quantization ranges
+
+    graph: (default the default graph)
+    """
+    if graph is None:
+        graph = tf.get_default_graph()
+    return dict(_LAYER_OUTPUTS.get(graph, {}))
+
+
+@contextmanager
+def quantized(ranges, n_bits=8):
+    """Context in which the outputs of non_linearity and batch_norm layers are
+    quantized in polar form with quantize_polar. Use it with frozen() to
+    build a quantized inference graph.
+
+    ranges: dict {layer name: largest magnitude, shape [order,1,channels]}
+    n_bits: (default 8)
+    """
+    previous = (_QUANTIZE['ranges'], _QUANTIZE['n_bits'])
+    _QUANTIZE['ranges'] = ranges
+    _QUANTIZE['n_bits'] = n_bits
+    try:
+        yield
+    finally:
+        _QUANTIZE['ranges'], _QUANTIZE['n_bits'] = previous
@@ -0,0 +1,242 @@
+"""
+Harmonic Convolutions in NumPy
+
+Inference for trained harmonic networks without tensorflow. The layers mirror
+harmonic_network_lite, but take their filters and parameters from the npz
+file written by harmonic_network_lite.export, so there is no graph to build.
+Activations have the layout [batch,height,width,order,complex,channels] and
+are computed in float32. The convolutions, nonlinearities and pooling are
+split into tiles of batch items and output rows, which run on a thread pool,
+see set_num_threads.
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+def load(filename):
+    """Load the parameters written by harmonic_network_lite.export as a dict
+    {name: array}"""
+    with np.load(filename) as arrays:
+        return dict([(name, arrays[name]) for name in arrays.files])
+
+
+def relu(x):
+    """The default nonlinearity, as tf.nn.relu"""
+    return np.maximum(x, 0.)
+
+
+def conv2d(x, params, strides=(1,1,1,1), padding='VALID', max_order=1,
+           name='conv2d'):
+    """Harmonic convolution with the exported filter bank of the conv2d layer
+    called name
+
+    x: input array, shape [batchsize,height,width,order,complex,channels]
+    params: dict from load
+    strides: stride size (4-tuple: default (1,1,1,1))
+    padding: SAME or VALID (defult VALID)
+    max_order: maximum output rotation order, as for the layer (default 1)
+    name: name of the layer (default 'conv2d')
+    """
+    bank = params[name]
+    rows = params[name+'_rows']
+    cols = params[name+'_cols']
+    xsh = x.shape
+    # Only the input streams meeting nonzero filters are in the bank
+    x = np.reshape(x, xsh[:3] + (xsh[3]*xsh[4], xsh[5]))[:,:,:,rows]
+    x = np.reshape(x, xsh[:3] + (-1,))
+    y = conv(x, bank, strides=strides, padding=padding)
+    # Put back the output streams which are zero
+    ysh = y.shape
+    n_out = ysh[3] // len(cols)
+    Y = np.zeros(ysh[:3] + (2*(max_order+1), n_out), dtype=y.dtype)
+    Y[:,:,:,cols] = np.reshape(y, ysh[:3] + (len(cols), n_out))
+    return np.reshape(Y, ysh[:3] + (max_order+1, 2, n_out))
+
+
+def conv(x, w, strides=(1,1,1,1), padding='VALID'):
+    """Real 2D convolution (cross-correlation), as tf.nn.conv2d. It runs one
+    matrix product per filter tap and tile, on strided views of the input, so
+    no patch matrix of the whole input is built.
+
+    x: input array, shape [batchsize,height,width,in]
+    w: filter array, shape [h,w,in,out]
+    strides: stride size (4-tuple: default (1,1,1,1))
+    padding: SAME or VALID (defult VALID)
+    """
+    x = np.asarray(x, dtype=np.float32)
+    w = np.asarray(w, dtype=np.float32)
+    kh, kw = w.shape[:2]
+    sh, sw = strides[1:3]
+    if padding == 'SAME':
+        x = pad_same(x, (kh, kw), (sh, sw))
+    elif padding != 'VALID':
+        raise ValueError('Unknown padding: {:s}'.format(padding))
+    oh = (x.shape[1] - kh) // sh + 1
+    ow = (x.shape[2] - kw) // sw + 1
+    y = np.empty((x.shape[0], oh, ow, w.shape[3]), dtype=np.float32)
+    def run(tile):
+        # The input rows of a tile overlap those of its neighbours by kh-sh.
+        # Products of 2D arrays go to BLAS, which releases the GIL.
+        b0, b1, r0, r1 = tile
+        acc = np.zeros(((b1-b0)*(r1-r0)*ow, w.shape[3]), dtype=np.float32)
+        for i in range(kh):
+            for j in range(kw):
+                patch = x[b0:b1,i+sh*r0:i+sh*(r1-1)+1:sh,j:j+sw*(ow-1)+1:sw,:]
+                acc += np.dot(np.reshape(patch, [acc.shape[0], -1]), w[i,j])
+        y[b0:b1,r0:r1] = np.reshape(acc, [b1-b0, r1-r0, ow, -1])
+    map_tiles(run, x.shape[0], oh)
+    return y
+
+
+def pad_same(x, ksize, strides):
+    """Zero pad the spatial dimensions of x as tensorflow does for SAME
+    padding, putting the odd pixel at the end"""
+    pads = [(0,0)]
+    for n, k, s in zip(x.shape[1:3], ksize, strides):
+        out = (n + s - 1) // s
+        total = max((out - 1)*s + k - n, 0)
+        pads.append((total // 2, total - total // 2))
+    pads += [(0,0)]*(x.ndim - 3)
+    return np.pad(x, pads, mode='constant')
+
+
+def scaled_nonlin(x, fnc, scale, shift, eps=1e-12):
+    """Apply the nonlinearity fnc to scale*|x| + shift, keeping the phase of x,
+    as h_scaled_nonlin
+
+    x: array shape [batchsize,height,width,order,complex,channels]
+    fnc: nonlinearity on arrays. MUST map to non-negative reals R+
+    scale: array broadcastable to [order,1,channels]
+    shift: array broadcastable to [order,1,channels]
+    eps: regularization of the magnitude (default 1e-12)
+    """
+    y = np.empty(x.shape, dtype=np.float32)
+    def run(tile):
+        b0, b1, r0, r1 = tile
+        xt = x[b0:b1,r0:r1]
+        R = np.sum(np.square(xt), axis=4, keepdims=True)
+        r = np.sqrt(np.maximum(R, eps))
+        y[b0:b1,r0:r1] = fnc(scale*r + shift)*(xt/r)
+    map_tiles(run, x.shape[0], x.shape[1])
+    return y
+
+
+def non_linearity(x, params, fnc=relu, eps=1e-4, name='nl'):
+    """Nonlinearity on the magnitudes, with the bias of the non_linearity
+    layer called name"""
+    return scaled_nonlin(x, fnc, 1., params['b'+name], eps=eps)
+
+
+def batch_norm(x, params, fnc=relu, eps=1e-4, name='hbn'):
+    """Batch normalization on the magnitudes in test mode, with the folded
+    statistics of the batch_norm layer called name"""
+    return scaled_nonlin(x, fnc, params[name+'_scale'], params[name+'_shift'],
+                         eps=eps)
+
+
+def mean_pool(x, ksize=(1,1,1,1), strides=(1,1,1,1)):
+    """Mean pooling of the real and imaginary parts, with VALID padding"""
+    kh, kw = ksize[1:3]
+    sh, sw = strides[1:3]
+    oh = (x.shape[1] - kh) // sh + 1
+    ow = (x.shape[2] - kw) // sw + 1
+    y = np.zeros((x.shape[0], oh, ow) + x.shape[3:], dtype=np.float32)
+    def run(tile):
+        b0, b1, r0, r1 = tile
+        for i in range(kh):
+            for j in range(kw):
+                y[b0:b1,r0:r1] += x[b0:b1,i+sh*r0:i+sh*(r1-1)+1:sh,
+                                    j:j+sw*(ow-1)+1:sw]
+        y[b0:b1,r0:r1] /= kh*kw
+    map_tiles(run, x.shape[0], oh)
+    return y
+
+
+def sum_magnitudes(x, eps=1e-12, keep_dims=True):
+    """Sum the magnitudes of each of the complex feature maps in x over the
+    rotation orders"""
+    R = np.sum(np.square(x), axis=4, keepdims=keep_dims)
+    return np.sum(np.sqrt(np.maximum(R, eps)), axis=3, keepdims=keep_dims)
+
+
+def stack_magnitudes(x, eps=1e-12, keep_dims=True):
+    """Stack the magnitudes of each of the complex feature maps in x"""
+    R = np.sum(np.square(x), axis=4, keepdims=keep_dims)
+    return np.sqrt(np.maximum(R, eps))
+
+
+def resize_bilinear(x, size):
+    """Bilinear resizing of the spatial dimensions of x, shape
+    [batchsize,height,width,channels], as tf.image.resize_images
+
+    x: input array
+    size: (height, width) of the output
+    """
+    for axis, n in ((1, size[0]), (2, size[1])):
+        m = x.shape[axis]
+        position = np.arange(n)*(float(m)/n)
+        lo = np.floor(position).astype(np.int64)
+        hi = np.minimum(lo + 1, m - 1)
+        shape = [1,]*x.ndim
+        shape[axis] = n
+        frac = np.reshape(position - lo, shape).astype(np.float32)
+        x = (1. - frac)*np.take(x, lo, axis=axis) + frac*np.take(x, hi, axis=axis)
+    return x
+
+
+##### THREADING #####
+# The number of threads, and the pool running them
+_THREADS = {'n_threads': int(os.environ.get('HNET_NUM_THREADS', 1)),
+            'pool': None}
+
+
+def set_num_threads(n_threads):
+    """Run the layers on n_threads threads (default from the environment
+    variable HNET_NUM_THREADS, else 1). The work is done by numpy and BLAS,
+    which release the GIL, so the threads run in parallel. Limit BLAS to one
+    thread per call, e.g. with OMP_NUM_THREADS=1, so that the cores are not
+    oversubscribed.
+
+    n_threads: number of threads (int)
+    """
+    if _THREADS['pool'] is not None:
+        _THREADS['pool'].close()
+        _THREADS['pool'].join()
+        _THREADS['pool'] = None
+    _THREADS['n_threads'] = max(int(n_threads), 1)
+
+
+def tiles(batch_size, height, n_threads):
+    """Split an output of batch_size items and height rows into tiles
+    (b0,b1,r0,r1) of whole items and blocks of rows. There are about two
+    tiles per thread, so that uneven tiles still balance out.
+
+    batch_size: number of batch items (int)
+    height: number of output rows (int)
+    n_threads: number of threads (int)
+    """
+    n_items = min(batch_size, 2*n_threads)
+    n_rows = min(height, max(-(-2*n_threads // n_items), 1))
+    items = np.linspace(0, batch_size, n_items+1).astype(int)
+    rows = np.linspace(0, height, n_rows+1).astype(int)
+    return [(items[i], items[i+1], rows[j], rows[j+1])
+            for i in range(n_items) for j in range(n_rows)]
+
+
+def map_tiles(fnc, batch_size, height):
+    """Call fnc on every tile of an output, see tiles, using the thread pool
+
+    fnc: function of a tile (b0,b1,r0,r1), writing its part of the output
+    batch_size: number of batch items (int)
+    height: number of output rows (int)
+    """
+    n_threads = _THREADS['n_threads']
+    if n_threads == 1 or batch_size*height < 2:
+        fnc((0, batch_size, 0, height))
+        return
+    if _THREADS['pool'] is None:
+        _THREADS['pool'] = ThreadPool(n_threads)
+    _THREADS['pool'].map(fnc, tiles(batch_size, height, n_threads))
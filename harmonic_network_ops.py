@@ -2,62 +2,78 @@
 Core Harmonic Convolution Implementation
 """
 
+import os
+import weakref
+
 import numpy as np
 import tensorflow as tf
 
+from tensorflow.python.framework import function
+
 
-def h_conv(X, W, strides=(1,1,1,1), padding='VALID', max_order=1, name='h_conv'):
+def h_conv(X, W, strides=(1,1,1,1), padding='VALID', max_order=1,
+           algorithm='direct', name='h_conv'):
     """Inter-order (cross-stream) convolutions can be implemented as single
     convolution. For this we store data as 6D tensors and filters as 8D
     tensors, at convolution, we reshape down to 4D tensors and expand again.
 
-    X: tensor shape [mbatch,h,w,order,complex,channels]
-    Q: tensor dict---reshaped to [h,w,in,in.comp,in.ord,out,out.comp,out.ord]
-    P: tensor dict---phases
+    X: tensor shape [mbatch,h,w,order,complex,channels], where mbatch, h and w
+    may be unknown
+    W: filter stack [order,complex,h,w,in,out] from get_filter_stack, dict
+    {order: (real, imaginary)} from get_filters, or 4D filter bank from
+    get_filter_bank
     strides: as per tf convention (default (1,1,1,1))
     padding: as per tf convention (default VALID)
-    filter_size: (default 3)
     max_order: (default 1)
+    algorithm: 'direct' spatial convolution, 'fft' convolution in the
+    frequency domain, which is faster for large images and filters, or
+    'gauss' to form the products of complex inputs and filters from three
+    real convolutions instead of four, see gauss_conv (default 'direct')
     name: (default h_conv)
     """
+    if algorithm == 'gauss' and X.get_shape().as_list()[4] == 2:
+        return gauss_conv(X, W, strides=strides, padding=padding,
+                          max_order=max_order, name=name)
+    elif algorithm == 'gauss':
+        # Real inputs have no complex products to save on
+        algorithm = 'direct'
     with tf.name_scope('hconv'+str(name)) as scope:
         # Build data tensor: reshape it as [mbatch,h,w,order*complex*channels]
-        Xsh = X.get_shape().as_list()
-        X_ = tf.reshape(X, tf.concat(axis=0,values=[Xsh[:3],[-1]]))
+        Xsh = dynamic_shape(X)
+        X_ = tf.reshape(X, Xsh[:3]+[-1])
 
-        # The script below constructs the stream-convolutions as one big filter
-        # W_. For each output order, run through each input order and
-        # copy-paste the filter for that convolution.
-        W_ = []
-        for output_order in xrange(max_order+1):
-            # For each output order build input
-            Wr = []
-            Wi = []
-            for input_order in xrange(Xsh[3]):
-                # Difference in orders is the convolution order
-                weight_order = output_order - input_order
-                weights = W[np.abs(weight_order)]
-                sign = np.sign(weight_order)
-                # Choose a different filter depending on whether input is real.
-                # We have the arbitrary convention that negative orders use the
-                # conjugate weights.
-                if Xsh[4] == 2:
-                    Wr += [weights[0],-sign*weights[1]]
-                    Wi += [weights[1],sign*weights[0]]
-                else:
-                    Wr += [weights[0]]
-                    Wi += [weights[1]]
-            W_ += [tf.concat(axis=2, values=Wr), tf.concat(axis=2, values=Wi)]
-        W_ = tf.concat(axis=3, values=W_)
+        # Gather the stream-convolutions into one big filter W_
+        if isinstance(W, dict) or W.get_shape().ndims == 6:
+            W_ = get_filter_bank(W, Xsh[3], Xsh[4], max_order)
+        else:
+            W_ = W
 
         # Convolve
-        Y = tf.nn.conv2d(X_, W_, strides=strides, padding=padding, name=name)
+        if algorithm == 'fft':
+            Y = fft_conv2d(X_, W_, strides=strides, padding=padding, name=name)
+        elif algorithm == 'direct':
+            Y = tf.nn.conv2d(X_, W_, strides=strides, padding=padding, name=name)
+        else:
+            raise ValueError('Unknown algorithm: {:s}'.format(algorithm))
         # Reshape result into appropriate format
-        Ysh = Y.get_shape().as_list()
-        new_shape = tf.concat(axis=0, values=[Ysh[:3],[max_order+1,2],[Ysh[3]/(2*(max_order+1))]])
+        Ysh = dynamic_shape(Y)
+        new_shape = Ysh[:3] + [max_order+1, 2, Ysh[3]/(2*(max_order+1))]
         return tf.reshape(Y, new_shape)
 
 
+def dynamic_shape(X):
+    """Return the shape of X as a list, holding the known dimensions as ints
+    and the unknown ones, e.g. the batch size and image size of a placeholder
+    of shape [None,None,None,...], as scalar tensors. Reshaping with it keeps
+    the known dimensions in the static shape.
+
+    X: tensor of known rank
+    """
+    static = X.get_shape().as_list()
+    dynamic = tf.unstack(tf.shape(X), num=len(static))
+    return [d if s is None else s for s, d in zip(static, dynamic)]
+
+
 def h_range_conv(X, W, strides=(1,1,1,1), padding='VALID', in_range=(0,1),
                       out_range=(0,1), name='r_conv'):
     """Inter-order (cross-stream) convolutions can be implemented as single
@@ -76,8 +92,8 @@ def h_range_conv(X, W, strides=(1,1,1,1), padding='VALID', in_range=(0,1),
     """
     with tf.name_scope('hconv'+str(name)) as scope:
         # Build data tensor: reshape it as [mbatch,h,w,order*complex*channels]
-        Xsh = X.get_shape().as_list()
-        X_ = tf.reshape(X, tf.concat(axis=0,values=[Xsh[:3],[-1]]))
+        Xsh = dynamic_shape(X)
+        X_ = tf.reshape(X, Xsh[:3]+[-1])
 
         # The script below constructs the stream-convolutions as one big filter
         # W_. For each output order, run through each input order and copy-paste
@@ -106,14 +122,298 @@ def h_range_conv(X, W, strides=(1,1,1,1), padding='VALID', in_range=(0,1),
         # Convolve
         Y = tf.nn.conv2d(X_, W_, strides=strides, padding=padding, name=name)
         # Reshape result into appropriate format
-        Ysh = Y.get_shape().as_list()
+        Ysh = dynamic_shape(Y)
         diff = out_range[1] - out_range[0] + 1
-        new_shape = tf.concat(axis=0, values=[Ysh[:3],[diff,2],[Ysh[3]/(2*diff)]])
+        new_shape = Ysh[:3] + [diff, 2, Ysh[3]/(2*diff)]
+        return tf.reshape(Y, new_shape)
+
+
+def get_filter_bank(W, n_orders, n_complex, max_order):
+    """Assemble the filters of all cross-order convolutions into one 4D filter
+    bank of shape [h,w,n_orders*n_complex*in,(max_order+1)*2*out] from the
+    atoms of the filter stack and their negatives, with one concatenation
+    per output stream and one across them. Concatenating contiguous blocks
+    is much faster than gathering the atoms and transposing them into place.
+    The streams are all kept, even those which only meet zero filters, see
+    nonzero_blocks: in tensorflow, putting a skipped output stream back
+    costs more than convolving it.
+
+    W: filter stack [order,complex,h,w,in,out] of orders 0,1,... from
+    get_filter_stack, or dict {order: (real, imaginary)} from get_filters
+    n_orders: number of input rotation orders
+    n_complex: 1 for real inputs, 2 for complex inputs
+    max_order: maximum output rotation order
+    """
+    index, sign = filter_bank_indices(n_orders, n_complex, max_order)
+    if isinstance(W, dict):
+        W = tf.stack([tf.stack(W[m]) for m in xrange(np.amax(index)//2+1)])
+    Wsh = W.get_shape().as_list()
+    index = np.reshape(index, [-1, n_orders*n_complex])
+    sign = np.reshape(sign, [-1, n_orders*n_complex])
+    atoms = tf.reshape(W, [-1,]+Wsh[2:])
+    blocks = {1.: tf.unstack(atoms)}
+    if np.any(sign < 0):
+        blocks[-1.] = tf.unstack(-atoms)
+    if np.any(sign == 0):
+        blocks[0.] = [tf.zeros_like(blocks[1.][0]),]*len(blocks[1.])
+    # [in.stream*in] for each output stream, then [out.stream*out]
+    columns = [tf.concat(axis=2, values=[blocks[s][i] for i, s in zip(ic, sc)])
+               for ic, sc in zip(index, sign)]
+    return tf.concat(axis=3, values=columns)
+
+
+def nonzero_blocks(sign):
+    """Return the input streams (in.ord*n_complex + in.comp) and output
+    streams (2*out.ord + out.comp) of a filter bank which meet at least one
+    nonzero filter, given the signs from filter_bank_indices"""
+    sign = np.reshape(sign, [sign.shape[0]*sign.shape[1], -1])
+    rows = np.flatnonzero(np.any(sign != 0, axis=0))
+    cols = np.flatnonzero(np.any(sign != 0, axis=1))
+    return [int(i) for i in rows], [int(i) for i in cols]
+
+
+def filter_bank_indices(n_orders, n_complex, max_order, real_order0=False):
+    """Return the atoms and signs making up the filter bank of get_filter_bank.
+    Both arrays have shape [max_order+1,2,n_orders,n_complex], indexed by
+    [out.ord,out.comp,in.ord,in.comp]. Atom 2*m is the real part of the order
+    m filter and atom 2*m+1 its imaginary part. Filters which are zero have
+    sign 0: the imaginary input of same-order convolutions, and atom 1 if
+    real_order0.
+    """
+    shape = (max_order+1, 2, n_orders, n_complex)
+    index = np.zeros(shape, dtype=np.int32)
+    sign = np.ones(shape, dtype=np.float32)
+    for output_order in xrange(max_order+1):
+        for input_order in xrange(n_orders):
+            # Difference in orders is the convolution order
+            weight_order = output_order - input_order
+            real = 2*np.abs(weight_order)
+            imag = real + 1
+            # Choose a different filter depending on whether input is real. We
+            # have the arbitrary convention that negative orders use the
+            # conjugate weights.
+            index[output_order,:,input_order,0] = (real, imag)
+            if n_complex == 2:
+                index[output_order,:,input_order,1] = (imag, real)
+                sign[output_order,:,input_order,1] = (-np.sign(weight_order),
+                                                      np.sign(weight_order))
+    if real_order0:
+        sign[index == 1] = 0.
+    return index, sign
+
+
+def gauss_conv(X, W, strides=(1,1,1,1), padding='VALID', max_order=1,
+               name='gauss_conv'):
+    """Cross-order convolution of complex inputs using Gauss' trick. With
+    x' = sign(d)*x_i for the convolution order d = out.ord - in.ord, each
+    stream is the complex product (x_r + ix')(a + ib) of the input and the
+    order |d| filter, which we compute from the three real convolutions
+
+        k1 = (x_r + x')*a,  k2 = x_r*(b - a),  k3 = x'*(a + b)
+        Y_r = k1 - k3,  Y_i = k1 + k2.
+
+    For d = 0 the imaginary input is not used, so the product costs two real
+    convolutions. All input orders sharing a convolution order use the same
+    filter, so they are stacked along the batch dimension and convolved
+    together.
+
+    X: tensor shape [mbatch,h,w,order,2,channels]
+    W: filter stack [order,complex,h,w,in,out] from get_filter_stack, or dict
+    {order: (real, imaginary)} from get_filters
+    strides: as per tf convention (default (1,1,1,1))
+    padding: as per tf convention (default VALID)
+    max_order: (default 1)
+    name: (default gauss_conv)
+    """
+    with tf.name_scope('gconv'+str(name)) as scope:
+        n_orders = X.get_shape().as_list()[3]
+        if isinstance(W, dict):
+            W = tf.stack([tf.stack(W[m])
+                          for m in xrange(max(max_order, n_orders-1)+1)])
+        Wsh = W.get_shape().as_list()
+        Yr = [[] for __ in xrange(max_order+1)]
+        Yi = [[] for __ in xrange(max_order+1)]
+        for d in xrange(1-n_orders, max_order+1):
+            input_orders = range(max(0,-d), min(n_orders, max_order+1-d))
+            a = W[abs(d),0]
+            b = W[abs(d),1]
+            xr = tf.concat(axis=0, values=[X[:,:,:,i,0,:] for i in input_orders])
+            if d == 0:
+                # Y_r = x_r*a and Y_i = x_r*b in one convolution
+                k = tf.nn.conv2d(xr, tf.concat(axis=3, values=[a,b]),
+                                 strides=strides, padding=padding)
+                k = tf.split(axis=0, num_or_size_splits=len(input_orders),
+                             value=k)
+                for i, ki in zip(input_orders, k):
+                    Yr[i].append(ki[:,:,:,:Wsh[5]])
+                    Yi[i].append(ki[:,:,:,Wsh[5]:])
+                continue
+            xi = tf.concat(axis=0, values=[X[:,:,:,i,1,:] for i in input_orders])
+            if d < 0:
+                xi = -xi
+            k1 = tf.nn.conv2d(xr + xi, a, strides=strides, padding=padding)
+            k2 = tf.nn.conv2d(xr, b - a, strides=strides, padding=padding)
+            k3 = tf.nn.conv2d(xi, a + b, strides=strides, padding=padding)
+            k1 = tf.split(axis=0, num_or_size_splits=len(input_orders), value=k1)
+            k2 = tf.split(axis=0, num_or_size_splits=len(input_orders), value=k2)
+            k3 = tf.split(axis=0, num_or_size_splits=len(input_orders), value=k3)
+            for j, i in enumerate(input_orders):
+                Yr[i+d].append(k1[j] - k3[j])
+                Yi[i+d].append(k1[j] + k2[j])
+        Y = [tf.stack([tf.add_n(Yr[m]), tf.add_n(Yi[m])], axis=3)
+             for m in xrange(max_order+1)]
+        return tf.stack(Y, axis=3, name=name)
+
+
+def fft_conv2d(x, w, strides=(1,1,1,1), padding='VALID', name='fft_conv2d'):
+    """Drop-in replacement for tf.nn.conv2d, computing the cross-correlation
+    in the frequency domain. The input and flipped filter are zero-padded to
+    the size of their full linear convolution, so there is no wrap-around,
+    and the result is cropped according to the SAME/VALID convention.
+
+    x: tensor shape [mbatch,h,w,in]
+    w: tensor shape [kh,kw,in,out]
+    strides: as per tf convention (default (1,1,1,1))
+    padding: as per tf convention (default VALID)
+    name: (default fft_conv2d)
+    """
+    with tf.name_scope(name) as scope:
+        # The FFTs run in complex64, so reduced precision inputs are upcast
+        dtype = x.dtype
+        x = tf.cast(x, tf.float32)
+        w = tf.cast(w, tf.float32)
+        xsh = dynamic_shape(x)
+        wsh = w.get_shape().as_list()
+        # Move spatial dimensions innermost, flip the filter, and zero-pad
+        # both to the size of the full convolution
+        x_ = tf.transpose(x, (0,3,1,2))
+        x_ = tf.pad(x_, [[0,0],[0,0],[0,wsh[0]-1],[0,wsh[1]-1]])
+        w_ = tf.reverse(tf.transpose(w, (2,3,0,1)), [2,3])
+        w_ = tf.pad(w_, [[0,0],[0,0],[0,xsh[1]-1],[0,xsh[2]-1]])
+        xf = tf.fft2d(tf.complex(x_, tf.zeros_like(x_)))
+        wf = tf.fft2d(tf.complex(w_, tf.zeros_like(w_)))
+        # Sum over input channels at each frequency with a batched matmul of
+        # [h,w,mbatch,in] and [h,w,in,out]
+        yf = tf.matmul(tf.transpose(xf, (2,3,0,1)), tf.transpose(wf, (2,3,0,1)))
+        y = tf.real(tf.ifft2d(tf.transpose(yf, (2,3,0,1))))
+        # Entry n of the full convolution sees inputs n-k+1,...,n
+        begin = []
+        end = []
+        for i in xrange(2):
+            if padding == 'SAME':
+                n_out = -(-xsh[i+1] // strides[i+1])
+                pad_total = (n_out-1)*strides[i+1] + wsh[i] - xsh[i+1]
+                if isinstance(pad_total, int):
+                    pad_total = max(pad_total, 0)
+                else:
+                    pad_total = tf.maximum(pad_total, 0)
+                begin.append(wsh[i] - 1 - pad_total//2)
+            elif padding == 'VALID':
+                n_out = -(-(xsh[i+1] - wsh[i] + 1) // strides[i+1])
+                begin.append(wsh[i] - 1)
+            else:
+                raise ValueError('Unknown padding: {:s}'.format(padding))
+            end.append(begin[i] + (n_out-1)*strides[i+1] + 1)
+        y = y[:,:,begin[0]:end[0]:strides[1],begin[1]:end[1]:strides[2]]
+        return tf.cast(tf.transpose(y, (0,2,3,1)), dtype)
+
+
+def h_basis_conv(X, M, filter_size, strides=(1,1,1,1), padding='VALID',
+                 max_order=1, n_rings=None, basis_type='dft', name='h_basis_conv'):
+    """Basis-first harmonic convolution. Every harmonic filter is a linear
+    combination of the fixed ring basis, so we convolve each input channel
+    with the basis once (depthwise) and apply the learned radial profiles and
+    phases as a 1x1 mixing. Same output as h_conv, but cheaper for layers
+    with many output channels: per pixel it costs in*n_basis*(h*w+out)
+    multiplications, against in*h*w*out for h_conv.
+
+    X: tensor shape [mbatch,h,w,order,complex,channels]
+    M: mixing matrix from get_basis_mixing
+    filter_size: size of square filter (int)
+    strides: as per tf convention (default (1,1,1,1))
+    padding: as per tf convention (default VALID)
+    max_order: (default 1)
+    n_rings: number of rings (default max(filter_size/2, 2))
+    basis_type: 'dft' or 'quadrature' (default 'dft')
+    name: (default h_basis_conv)
+    """
+    with tf.name_scope('hconv'+str(name)) as scope:
+        # Build data tensor: reshape it as [mbatch,h,w,order*complex*channels]
+        Xsh = dynamic_shape(X)
+        X_ = tf.reshape(X, Xsh[:3]+[-1])
+        n_in = int(np.prod(Xsh[3:]))
+        if n_rings is None:
+            n_rings = np.maximum(filter_size/2, 2)
+        n_basis = M.get_shape().as_list()[0] // n_in
+        n_weight_orders = (n_basis // n_rings + 1) // 2
+        basis = get_depthwise_basis_constant(filter_size, n_weight_orders, n_in,
+                                             n_rings=n_rings,
+                                             basis_type=basis_type)
+        # Convolve with the fixed basis, then mix. There are no reduced
+        # precision depthwise kernels, so that convolution runs in float32
+        Y = tf.nn.depthwise_conv2d(tf.cast(X_, tf.float32), basis,
+                                   strides=strides, padding=padding)
+        Y = tf.cast(Y, X.dtype)
+        Y = tf.nn.conv2d(Y, tf.expand_dims(tf.expand_dims(M, 0), 0),
+                         strides=(1,1,1,1), padding='VALID', name=name)
+        # Reshape result into appropriate format
+        Ysh = dynamic_shape(Y)
+        new_shape = Ysh[:3] + [max_order+1, 2, Ysh[3]/(2*(max_order+1))]
         return tf.reshape(Y, new_shape)
 
 
+def get_basis_mixing(R, n_orders, n_complex, max_order, P=None):
+    """Return the matrix mixing the basis responses of h_basis_conv into the
+    output channels, of shape [n_orders*n_complex*in*n_basis,
+    (max_order+1)*2*out]. The basis responses are ordered as
+    [weight order, cos/sin, ring], without the order 0 sine basis, which is
+    zero, and the output channels as in h_conv.
+
+    R: dict of radial profiles {order: [n_rings,in,out]}, orders 0,1,...
+    n_orders: number of input rotation orders
+    n_complex: 1 for real inputs, 2 for complex inputs
+    max_order: maximum output rotation order
+    P: dict of phases {order: [1,1,in,out]} (default None)
+    """
+    orders = sorted(R.keys())
+    rsh = R[orders[0]].get_shape().as_list()
+    r = tf.stack([R[m] for m in orders])
+    r = tf.reshape(r, [len(orders), 1, 1, rsh[0], rsh[1], rsh[2]])
+    # Coefficients [order,complex,cos/sin,ring,in,out] of each filter in the
+    # stack of get_filter_stack on the cosine and sine bases
+    if P is not None:
+        phase = tf.stack([P[m] for m in orders])
+        phase = tf.reshape(phase, [len(orders), 1, rsh[1], rsh[2]])
+        c = tf.cos(phase)
+        s = tf.sin(phase)
+        rotation = tf.stack([tf.stack([c, s], axis=1),
+                             tf.stack([-s, c], axis=1)], axis=1)
+        C = rotation*r
+    else:
+        C = np.reshape(np.eye(2, dtype=np.float32), [1,2,2,1,1,1])*r
+    C = tf.reshape(C, [2*len(orders), 2*rsh[0], rsh[1], rsh[2]])
+    # Pick the coefficients of each cross-order filter, as in get_filter_bank,
+    # and place them on the basis of their weight order
+    index, sign = filter_bank_indices(n_orders, n_complex, max_order)
+    one_hot = (np.arange(len(orders)) == (index[...,np.newaxis] // 2))
+    mask = sign[...,np.newaxis]*one_hot
+    M = tf.expand_dims(tf.gather(C, index), 4)
+    M = M*np.reshape(mask, mask.shape+(1,1,1))
+    # [out.ord,out.comp,in.ord,in.comp,order,cos/sin*ring,in,out] to
+    # [in.ord,in.comp,in,order,cos/sin*ring,out.ord,out.comp,out]
+    M = tf.transpose(M, (2,3,6,4,5,0,1,7))
+    M = tf.reshape(M, [n_orders*n_complex*rsh[1], len(orders)*2*rsh[0],
+                       (max_order+1)*2*rsh[2]])
+    M = tf.concat(axis=1, values=[M[:,:rsh[0],:], M[:,2*rsh[0]:,:]])
+    return tf.reshape(M, [n_orders*n_complex*rsh[1]*(2*len(orders)-1)*rsh[0],
+                          (max_order+1)*2*rsh[2]])
+
 
 ##### NONLINEARITIES #####
+# Fused nonlinearities, memoized per (fnc, eps, dtype)
+_FUSED_NONLINS = {}
+
+
 def h_nonlin(X, fnc, eps=1e-12, name='b'):
     """Apply the nonlinearity described by the function handle fnc: R -> R+ to
     the magnitude of X. CAVEAT: fnc must map to the non-negative reals R+.
@@ -125,16 +425,88 @@ def h_nonlin(X, fnc, eps=1e-12, name='b'):
     fnc: function handle for a nonlinearity. MUST map to non-negative reals R+
     eps: regularization since grad |Z| is infinite at zero (default 1e-8)
     """
-    magnitude = stack_magnitudes(X, eps)
-    msh = magnitude.get_shape()
-    b = tf.get_variable('b'+name, shape=[1,1,1,msh[3],1,msh[5]])
+    Xsh = X.get_shape()
+    b = tf.get_variable('b'+name, shape=[1,1,1,Xsh[3],1,Xsh[5]])
+    return h_scaled_nonlin(X, fnc, tf.ones_like(b), b, eps=eps, name=name)
+
+
+def h_scaled_nonlin(X, fnc, scale, shift, eps=1e-12, name='hsn'):
+    """Apply the nonlinearity fnc to an affine function of the magnitude of X
+
+    Output U + iV = fnc(scale*R + shift) * (A+iB)
+    where  A + iB = Z/|Z|
+
+    With scale 1 this is h_nonlin, and with the population statistics folded
+    into scale and shift by fold_batch_norm, it is h_batch_norm in test mode.
+    It is computed by a single function call, see fused_nonlin, which only
+    keeps the squared magnitude of X for the backward pass. Reduced precision
+    X is upcast to float32 inside, and the output has the dtype of X.
+
+    X: tensor shape [mbatch,h,w,order,complex,channels]
+    fnc: function handle for a nonlinearity. MUST map to non-negative reals R+
+    scale: float32 tensor shape [order,1,channels] or [1,1,1,order,1,channels]
+    shift: float32 tensor shape [order,1,channels] or [1,1,1,order,1,channels]
+    eps: regularization since grad |Z| is infinite at zero (default 1e-12)
+    name: (default hsn)
+    """
+    with tf.name_scope(name) as scope:
+        Y, __ = fused_nonlin(fnc, eps=eps, dtype=X.dtype)(X, scale, shift)
+        Y.set_shape(X.get_shape())
+        return Y
 
-    Rb = tf.add(magnitude, b)
-    c = tf.div(fnc(Rb), magnitude)
-    return c*X
 
+def fused_nonlin(fnc, eps=1e-12, dtype=tf.float32):
+    """Return the memoized tf function (X, scale, shift) -> (Y, R), where Y is
+    the output of h_scaled_nonlin and R the squared magnitude of X. Its
+    gradient is computed analytically from X and R, so none of the
+    intermediate activations of the forward pass are stored. Everything is
+    computed in float32, R is float32 and Y has the dtype of X.
 
-def h_batch_norm(X, fnc, train_phase, decay=0.99, eps=1e-12, name='hbn'):
+    fnc: function handle for a nonlinearity. MUST map to non-negative reals R+
+    eps: regularization since grad |Z| is infinite at zero (default 1e-12)
+    dtype: dtype of X and Y (default tf.float32)
+    """
+    key = (fnc, eps, dtype)
+    if key in _FUSED_NONLINS:
+        return _FUSED_NONLINS[key]
+
+    def grad(op, dY, dR):
+        __, scale, shift = op.inputs
+        # Only recompute the magnitudes once dY arrives, so that they are not
+        # computed right after the forward pass and kept until backprop
+        with tf.control_dependencies([dY]):
+            X = tf.cast(tf.identity(op.inputs[0]), tf.float32)
+            R = tf.identity(op.outputs[1])
+        dY = tf.cast(dY, tf.float32)
+        r = tf.sqrt(tf.maximum(R, eps))
+        u = scale*r + shift
+        f = fnc(u)
+        # Y = f(u)*X/r, so dL/du = f'(u)*q/r with q = <dY,X> per channel
+        q = tf.reduce_sum(dY*X, axis=[4], keep_dims=True)
+        du = tf.gradients(f, u, grad_ys=q/r)[0]
+        dr = du*scale - f*q/tf.square(r)
+        # The magnitude is clamped at sqrt(eps)
+        dr = dr*tf.cast(tf.greater(R, eps), tf.float32)
+        dX = tf.cast((f/r)*dY + (dr/r)*X, dtype)
+        dscale = tf.reduce_sum(du*r, axis=[0,1,2], keep_dims=True)
+        dshift = tf.reduce_sum(du, axis=[0,1,2], keep_dims=True)
+        return (dX, tf.reshape(dscale, tf.shape(scale)),
+                tf.reshape(dshift, tf.shape(shift)))
+
+    @function.Defun(dtype, tf.float32, tf.float32, python_grad_func=grad,
+                    func_name='HScaledNonlin{:d}'.format(len(_FUSED_NONLINS)))
+    def forward(X, scale, shift):
+        X = tf.cast(X, tf.float32)
+        R = tf.reduce_sum(tf.square(X), axis=[4], keep_dims=True)
+        r = tf.sqrt(tf.maximum(R, eps))
+        return tf.cast(fnc(scale*r + shift)*(X/r), dtype), R
+
+    _FUSED_NONLINS[key] = forward
+    return forward
+
+
+def h_batch_norm(X, fnc, train_phase, decay=0.99, eps=1e-12, update_stats=True,
+                 name='hbn'):
     """Batch normalization for the magnitudes of X
 
     X: dict of channels {rotation order: (real, imaginary)}
@@ -142,13 +514,15 @@ def h_batch_norm(X, fnc, train_phase, decay=0.99, eps=1e-12, name='hbn'):
     train_phase: boolean flag True: training mode, False: test mode
     decay: decay rate: 0 is memory-less, 1 no updates (default 0.99)
     eps: regularization since grad |Z| is infinite at zero (default 1e-8)
+    update_stats: update the population statistics in training mode
+    (default True)
     name: (default complexBatchNorm)
     """
     with tf.name_scope(name) as scope:
         magnitude = stack_magnitudes(X, eps)
-        Rb = bn(magnitude, train_phase, decay=decay, name=name)
-        c = tf.div(fnc(Rb), magnitude)
-        return c*X
+        scale, shift = bn_affine(magnitude, train_phase, decay=decay,
+                                 update_stats=update_stats, name=name)
+        return h_scaled_nonlin(X, fnc, scale, shift, eps=eps, name='nonlin')
 
 
 def bn(X, train_phase, decay=0.99, name='batchNorm'):
@@ -161,6 +535,24 @@ def bn(X, train_phase, decay=0.99, name='batchNorm'):
 
     Source: bgshi @ http://stackoverflow.com/questions/33949786/how-could-i-use-
     batch-normalization-in-tensorflow"""
+    scale, shift = bn_affine(X, train_phase, decay=decay, name=name)
+    return scale*X + shift
+
+
+def bn_affine(X, train_phase, decay=0.99, eps=1e-3, update_stats=True,
+              name='batchNorm'):
+    """Return the per-channel scale and shift with which bn maps X to
+    scale*X + shift, using the batch statistics in training mode and the
+    population statistics in test mode.
+
+    X: tf tensor
+    train_phase: boolean flag True: training mode, False: test mode
+    decay: decay rate: 0 is memory-less, 1 no updates (default 0.99)
+    eps: regularization of the variance (default 1e-3)
+    update_stats: update the population statistics in training mode, turn
+    off when recomputing a forward pass (default True)
+    name: (default batchNorm)
+    """
     Xsh = X.get_shape().as_list()
     n_out = Xsh[-3:]
 
@@ -177,6 +569,8 @@ def bn(X, train_phase, decay=0.99, name='batchNorm'):
         ema = tf.train.ExponentialMovingAverage(decay=decay)
 
     def mean_var_with_update():
+        if not update_stats:
+            return tf.identity(batch_mean), tf.identity(batch_var)
         ema_apply_op = ema.apply([batch_mean, batch_var])
         pop_mean_op = tf.assign(pop_mean, ema.average(batch_mean))
         pop_var_op = tf.assign(pop_var, ema.average(batch_var))
@@ -186,8 +580,47 @@ def bn(X, train_phase, decay=0.99, name='batchNorm'):
 
     mean, var = tf.cond(train_phase, mean_var_with_update,
                 lambda: (pop_mean, pop_var))
-    normed = tf.nn.batch_normalization(X, mean, var, beta, gamma, 1e-3)
-    return normed
+    scale = gamma*tf.rsqrt(var + eps)
+    return scale, beta - mean*scale
+
+
+def fold_batch_norm(name='batchNorm', eps=1e-3):
+    """Return the per-channel scale and shift with which bn maps X to
+    scale*X + shift in test mode, from the variables of the bn called name
+    in the current variable scope
+
+    name: name of the bn (default batchNorm)
+    eps: as used by bn (default 1e-3)
+    """
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        beta = tf.get_variable(name+'_beta')
+        gamma = tf.get_variable(name+'_gamma')
+        pop_mean = tf.get_variable(name+'_pop_mean')
+        pop_var = tf.get_variable(name+'_pop_var')
+    scale = gamma*tf.rsqrt(pop_var + eps)
+    return scale, beta - pop_mean*scale
+
+
+def quantize_polar(X, max_magnitude, n_bits=8):
+    """Quantize complex feature maps in polar form. The magnitudes are
+    rounded to n_bits unsigned levels up to max_magnitude, and the unit
+    directions to n_bits signed levels. A rotation of the input only moves
+    the magnitudes and turns the directions, so unlike quantizing the real
+    and imaginary parts on a common grid, the invariant magnitudes are
+    quantized the same way for every orientation.
+
+    X: tensor shape [mbatch,h,w,order,complex,channels]
+    max_magnitude: largest representable magnitude, broadcastable to
+    [order,1,channels]
+    n_bits: (default 8)
+    """
+    magnitude = stack_magnitudes(X)
+    max_magnitude = tf.maximum(tf.cast(max_magnitude, tf.float32), 1e-12)
+    step = max_magnitude / (2.**n_bits - 1.)
+    q_magnitude = tf.round(tf.minimum(magnitude, max_magnitude)/step)*step
+    levels = 2.**(n_bits-1) - 1.
+    direction = tf.round(tf.cast(X, tf.float32)/magnitude*levels)/levels
+    return tf.cast(q_magnitude*direction, X.dtype)
 
 
 def mean_pooling(x, ksize=(1,1,1,1), strides=(1,1,1,1)):
@@ -198,25 +631,26 @@ def mean_pooling(x, ksize=(1,1,1,1), strides=(1,1,1,1)):
     ksize: kernel size 4-tuple (default (1,1,1,1))
     strides: stride size 4-tuple (default (1,1,1,1))
     """
-    Xsh = x.get_shape()
-    # Collapse output the order, complex, and channel dimensions
-    X_ = tf.reshape(x, tf.concat(axis=0,values=[Xsh[:3],[-1]]))
+    Xsh = dynamic_shape(x)
+    # Collapse output the order, complex, and channel dimensions, and
+    # accumulate in float32
+    X_ = tf.reshape(tf.cast(x, tf.float32), Xsh[:3]+[-1])
     Y = tf.nn.avg_pool(X_, ksize=ksize, strides=strides, padding='VALID',
                        name='mean_pooling')
-    Ysh = Y.get_shape()
-    new_shape = tf.concat(axis=0, values=[Ysh[:3],Xsh[3:]])
-    return tf.reshape(Y, new_shape)
+    Ysh = dynamic_shape(Y)
+    new_shape = Ysh[:3] + Xsh[3:]
+    return tf.cast(tf.reshape(Y, new_shape), x.dtype)
 
 
 def stack_magnitudes(X, eps=1e-12, keep_dims=True):
     """Stack the magnitudes of each of the complex feature maps in X.
 
-    Output U = concat(|X_i|)
+    Output U = concat(|X_i|), accumulated and returned in float32
 
     X: dict of channels {rotation order: (real, imaginary)}
     eps: regularization since grad |Z| is infinite at zero (default 1e-12)
     """
-    R = tf.reduce_sum(tf.square(X), axis=[4], keep_dims=keep_dims)
+    R = tf.reduce_sum(tf.square(tf.cast(X, tf.float32)), axis=[4], keep_dims=keep_dims)
     return tf.sqrt(tf.maximum(R,eps))
 
 
@@ -273,41 +707,88 @@ def get_interpolation_weights(filter_size, m, n_rings=None):
     return weights/np.sum(weights, axis=2, keepdims=True)
 
 
-def get_filters(R, filter_size, P=None, n_rings=None):
-    """Perform single-frequency DFT on each ring of a polar-resampled patch"""
-    k = filter_size
-    filters = {}
-    N = n_samples(k)
-    from scipy.linalg import dft
-    for m, r in R.iteritems():
-        rsh = r.get_shape().as_list()
-        # Get the basis matrices
-        weights = get_interpolation_weights(k, m, n_rings=n_rings)
-        DFT = dft(N)[m,:]
-        LPF = np.dot(DFT, weights).T
+def get_ring_coefficients(filter_size, m, n_rings=None):
+    """Compute the order m Fourier coefficients of the Gaussian interpolation
+    weights on each ring, with a trapezoidal quadrature whose length grows
+    with the ring radius. The integrand is smooth and periodic, so a few
+    dozen samples per ring are as accurate as the dense n_samples sampling.
+    Coefficients are scaled to match the n_samples-point DFT.
 
-        cosine = np.real(LPF).astype(np.float32)
-        sine = np.imag(LPF).astype(np.float32)
-        # Reshape for multiplication with radial profile
-        cosine = tf.constant(cosine)
-        sine = tf.constant(sine)
-        # Project taps on to rotational basis
-        r = tf.reshape(r, tf.stack([rsh[0],rsh[1]*rsh[2]]))
-        ucos = tf.reshape(tf.matmul(cosine, r), tf.stack([k, k, rsh[1], rsh[2]]))
-        usin = tf.reshape(tf.matmul(sine, r), tf.stack([k, k, rsh[1], rsh[2]]))
-        if P is not None:
-            # Rotate basis matrices
-            ucos_ = tf.cos(P[m])*ucos + tf.sin(P[m])*usin
-            usin = -tf.sin(P[m])*ucos + tf.cos(P[m])*usin
-            ucos = ucos_
-        filters[m] = (ucos, usin)
-    return filters
+    Returns a complex array of shape [n_rings, filter_size**2]
+    """
+    if n_rings is None:
+        n_rings = np.maximum(filter_size/2, 2)
+    radii = np.linspace(m!=0, n_rings-0.5, n_rings)
+    foveal_center = np.asarray([filter_size, filter_size])/2.
+    coords = L2_grid(foveal_center, filter_size)
+    N = n_samples(filter_size)
+    bandwidth = 0.5
+    # Never use more samples than the dense DFT
+    Nq = [int(np.minimum(n_quadrature(r, m, bandwidth), N)) for r in radii]
+    offsets = np.cumsum([0,] + Nq[:-1])
+    # Concatenate the samples of all rings, so we only evaluate one exp
+    lin = np.hstack([(2*np.pi*np.arange(n))/n for n in Nq])
+    radius = np.repeat(radii, Nq)
+    # Sample equi-angularly along each ring, as in get_interpolation_weights
+    I = -(radius*np.sin(lin))[:,np.newaxis] - coords[np.newaxis,0,:]
+    J = (radius*np.cos(lin))[:,np.newaxis] - coords[np.newaxis,1,:]
+    weights = np.exp(-0.5*(I**2 + J**2)/(bandwidth**2))
+    weights = weights/np.sum(weights, axis=1, keepdims=True)
+    # Order m DFT of each ring, rescaled to the n_samples-point DFT
+    DFT = np.exp(-1j*m*lin)*np.repeat(N/np.asarray(Nq, dtype=np.float64), Nq)
+    return np.add.reduceat(DFT[:,np.newaxis]*weights, offsets, axis=0)
+
+
+def get_filters(R, filter_size, P=None, n_rings=None, basis_type='dft'):
+    """Perform single-frequency DFT on each ring of a polar-resampled patch.
+    Returns a dict {order: (real, imaginary)}, see get_filter_stack.
+    """
+    W = get_filter_stack(R, filter_size, P=P, n_rings=n_rings,
+                         basis_type=basis_type)
+    return dict((m, (W[i,0], W[i,1])) for i, m in enumerate(sorted(R.keys())))
+
+
+def get_filter_stack(R, filter_size, P=None, n_rings=None, basis_type='dft'):
+    """Project the radial profiles of all orders on to their rotational bases
+    with a single batched matmul. Returns a tensor of shape
+    [order,complex,h,w,in,out], where the orders are sorted(R.keys()).
+
+    R: dict of radial profiles {order: [n_rings,in,out]}
+    filter_size: size of square filter (int)
+    P: dict of phases {order: [1,1,in,out]} (default None)
+    n_rings: number of rings (default max(filter_size/2, 2))
+    basis_type: 'dft' samples every ring at n_samples angles, 'quadrature'
+    uses a short per-ring quadrature (default 'dft')
+    """
+    k = filter_size
+    orders = sorted(R.keys())
+    rsh = R[orders[0]].get_shape().as_list()
+    # Basis of shape [order,complex*h*w,n_rings], shared between all layers
+    basis = get_basis_stack_constant(k, orders, n_rings=n_rings,
+                                     basis_type=basis_type)
+    r = tf.stack([R[m] for m in orders])
+    r = tf.reshape(r, [len(orders), rsh[0], rsh[1]*rsh[2]])
+    # Project taps on to rotational basis
+    W = tf.reshape(tf.matmul(basis, r), [len(orders), 2, k, k, rsh[1], rsh[2]])
+    if P is not None:
+        # Rotate basis matrices, (cos,sin) -> (c*cos+s*sin, -s*cos+c*sin)
+        phase = tf.stack([P[m] for m in orders])
+        phase = tf.reshape(phase, [len(orders), 1, 1, 1, rsh[1], rsh[2]])
+        swap = np.reshape(np.asarray([1., -1.], dtype=np.float32), [1,2,1,1,1,1])
+        W = tf.cos(phase)*W + tf.sin(phase)*swap*tf.reverse(W, [1])
+    return W
 
 
 def n_samples(filter_size):
     return np.maximum(np.ceil(np.pi*filter_size),101) ############## <--- One source of instability
 
 
+def n_quadrature(radius, m, bandwidth=0.5):
+    """Number of angular samples needed to integrate a ring of given radius to
+    ~1e-6 relative accuracy"""
+    return 2*int(np.ceil(4.*radius/bandwidth + 4. + m/2.))
+
+
 def L2_grid(center, shape):
     # Get neighbourhoods
     lin = np.arange(shape)+0.5
@@ -322,13 +803,14 @@ def get_weights_dict(shape, max_order, std_mult=0.4, n_rings=None, name='W'):
 
     shape: list of filter shape [h,w,i,o] --- note we use h=w
     max_order: returns weights for m=0,1,...,max_order, or if max_order is a
-    tuple, then it returns orders in the range.
+    tuple, then it returns orders in the range. h_conv only reads the
+    magnitude of the order difference, so negative orders are not created.
     std_mult: He init scaled by std_mult (default 0.4)
     name: (default 'W')
     dev: (default /cpu:0)
     """
     if isinstance(max_order, int):
-        orders = xrange(-max_order, max_order+1)
+        orders = xrange(max_order+1)
     else:
         diff = max_order[1]-max_order[0]
         orders = xrange(-diff, diff+1)
@@ -342,15 +824,19 @@ def get_weights_dict(shape, max_order, std_mult=0.4, n_rings=None, name='W'):
     return weights_dict
 
 
-def get_phase_dict(n_in, n_out, max_order, name='b'):
-    """Return a dict of phase offsets"""
+def get_phase_dict(n_in, n_out, max_order, real_order0=False, name='b'):
+    """Return a dict of phase offsets. With real_order0, the order 0 offset
+    is fixed at zero, so the order 0 filter stays real"""
     if isinstance(max_order, int):
-        orders = xrange(-max_order, max_order+1)
+        orders = xrange(max_order+1)
     else:
         diff = max_order[1]-max_order[0]
         orders = xrange(-diff, diff+1)
     phase_dict = {}
     for i in orders:
+        if real_order0 and i == 0:
+            phase_dict[i] = tf.zeros([1,1,n_in,n_out])
+            continue
         init = np.random.rand(1,1,n_in,n_out) * 2. *np.pi
         init = np.float32(init)
         phase = tf.get_variable(name+'_'+str(i), dtype=tf.float32,
@@ -358,3 +844,176 @@ def get_phase_dict(n_in, n_out, max_order, name='b'):
             initializer=tf.constant_initializer(init))
         phase_dict[i] = phase
     return phase_dict
+
+
+##### CHECKPOINTS #####
+def restore_variables(sess, checkpoint_path, var_list=None):
+    """Restore the variables of var_list that are stored in a checkpoint and
+    return the names of the checkpoint entries that were not used. Use this
+    to load checkpoints written before negative-order weights and phases were
+    dropped, since these contain variables that no longer exist in the graph.
+
+    sess: tf session
+    checkpoint_path: path to the checkpoint (prefix), or a directory
+    var_list: list of variables to restore (default all global variables)
+    """
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    if var_list is None:
+        var_list = tf.global_variables()
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    saved_shapes = reader.get_variable_to_shape_map()
+    restore_vars = []
+    for var in var_list:
+        name = var.op.name
+        if name in saved_shapes:
+            if var.get_shape().as_list() != saved_shapes[name]:
+                raise ValueError('Shape mismatch for {:s}: {} in graph, {} in '
+                                 'checkpoint'.format(name,
+                                 var.get_shape().as_list(), saved_shapes[name]))
+            restore_vars.append(var)
+    if len(restore_vars) > 0:
+        saver = tf.train.Saver(restore_vars)
+        saver.restore(sess, checkpoint_path)
+    restored = set([var.op.name for var in restore_vars])
+    return sorted([name for name in saved_shapes if name not in restored])
+
+
+##### STEERABLE BASIS CACHE #####
+# The ring basis only depends on (filter_size, order, n_rings, n_samples) and
+# the basis type, so we compute each one once per process and embed one
+# constant per graph.
+_BASIS_CACHE = {}
+_BASIS_CONSTANTS = weakref.WeakKeyDictionary()
+_BASIS_CACHE_STATS = {'hits': 0, 'misses': 0, 'constant_hits': 0,
+                      'constant_misses': 0}
+
+
+def basis_key(filter_size, m, n_rings=None, basis_type='dft'):
+    """Return the cache key (filter_size, m, n_rings, n_samples, basis_type)
+    of a basis"""
+    if n_rings is None:
+        n_rings = np.maximum(filter_size/2, 2)
+    if basis_type not in ('dft', 'quadrature'):
+        raise ValueError('Unknown basis_type: {:s}'.format(basis_type))
+    return (int(filter_size), int(m), int(n_rings), int(n_samples(filter_size)),
+            basis_type)
+
+
+def get_basis(filter_size, m, n_rings=None, basis_type='dft'):
+    """Return the memoized ring basis of rotation order m as a read-only pair
+    of numpy arrays (cosine, sine), each of shape [filter_size**2, n_rings]
+
+    filter_size: size of square filter (int)
+    m: rotation order (int)
+    n_rings: number of rings (default max(filter_size/2, 2))
+    basis_type: 'dft' or 'quadrature' (default 'dft')
+    """
+    key = basis_key(filter_size, m, n_rings=n_rings, basis_type=basis_type)
+    if key in _BASIS_CACHE:
+        _BASIS_CACHE_STATS['hits'] += 1
+        return _BASIS_CACHE[key]
+    _BASIS_CACHE_STATS['misses'] += 1
+    k, m, n_rings, N, basis_type = key
+    if basis_type == 'quadrature':
+        LPF = get_ring_coefficients(k, m, n_rings=n_rings).T
+    else:
+        weights = get_interpolation_weights(k, m, n_rings=n_rings)
+        # Row m of the DFT matrix, without building the full [N,N] matrix
+        DFT = np.exp(-2j*np.pi*m*np.arange(N)/N)
+        LPF = np.dot(DFT, weights).T
+
+    cosine = np.real(LPF).astype(np.float32)
+    sine = np.imag(LPF).astype(np.float32)
+    cosine.flags.writeable = False
+    sine.flags.writeable = False
+    _BASIS_CACHE[key] = (cosine, sine)
+    return cosine, sine
+
+
+def get_basis_stack_constant(filter_size, orders, n_rings=None,
+                             basis_type='dft'):
+    """Return the ring bases of several rotation orders as one tf constant of
+    shape [len(orders),2*filter_size**2,n_rings], holding the cosine rows
+    followed by the sine rows of each order.
+
+    filter_size: size of square filter (int)
+    orders: list of rotation orders
+    n_rings: number of rings (default max(filter_size/2, 2))
+    basis_type: 'dft' or 'quadrature' (default 'dft')
+    """
+    keys = tuple([basis_key(filter_size, m, n_rings=n_rings,
+                            basis_type=basis_type) for m in orders])
+    name = 'basis_{:s}_k{:d}_m{:s}_r{:d}'.format(basis_type, keys[0][0],
+                        '_'.join([str(m) for m in orders]), keys[0][2])
+    def basis():
+        return np.stack([np.vstack(get_basis(filter_size, m, n_rings=n_rings,
+                         basis_type=basis_type)) for m in orders])
+    return graph_constant(keys, basis, name)
+
+
+def get_depthwise_basis_constant(filter_size, n_orders, n_channels,
+                                 n_rings=None, basis_type='dft'):
+    """Return the ring bases of orders 0,...,n_orders-1 as a depthwise filter
+    of shape [filter_size,filter_size,n_channels,n_basis], which convolves
+    every channel with all n_basis = (2*n_orders-1)*n_rings basis functions.
+    The order 0 sine basis is zero, so it is left out.
+
+    filter_size: size of square filter (int)
+    n_orders: number of rotation orders
+    n_channels: number of input channels
+    n_rings: number of rings (default max(filter_size/2, 2))
+    basis_type: 'dft' or 'quadrature' (default 'dft')
+    """
+    orders = range(n_orders)
+    keys = tuple([basis_key(filter_size, m, n_rings=n_rings,
+                            basis_type=basis_type) for m in orders])
+    name = 'depthwise_basis_{:s}_k{:d}_m{:d}_r{:d}_c{:d}'.format(basis_type,
+                        keys[0][0], n_orders, keys[0][2], n_channels)
+    def basis():
+        k = filter_size
+        B = np.stack([np.vstack(get_basis(k, m, n_rings=n_rings,
+                      basis_type=basis_type)) for m in orders])
+        # [order,cos/sin*h*w,ring] to [h,w,order*cos/sin*ring]
+        B = np.reshape(B, [n_orders, 2, k, k, -1])
+        B = np.reshape(np.transpose(B, (2,3,0,1,4)), [k, k, 1, -1])
+        B = np.delete(B, np.s_[keys[0][2]:2*keys[0][2]], axis=3)
+        return np.tile(B, (1,1,n_channels,1))
+    return graph_constant(('depthwise', n_channels) + keys, basis, name)
+
+
+def graph_constant(key, value_fn, name):
+    """Return the constant stored under key in the current graph, creating it
+    from value_fn() on first use
+
+    key: hashable cache key
+    value_fn: function returning the numpy value of the constant
+    name: name of the constant op
+    """
+    graph = tf.get_default_graph()
+    constants = _BASIS_CONSTANTS.setdefault(graph, {})
+    if key in constants:
+        _BASIS_CACHE_STATS['constant_hits'] += 1
+        return constants[key]
+    _BASIS_CACHE_STATS['constant_misses'] += 1
+    # Place the constants at the top level of the graph, so that they can be
+    # shared across name scopes and control dependencies
+    with graph.name_scope(None), graph.control_dependencies(None):
+        constants[key] = tf.constant(value_fn(), name=name)
+    return constants[key]
+
+
+def basis_cache_info():
+    """Return the hit/miss counts and sizes of the basis cache"""
+    info = dict(_BASIS_CACHE_STATS)
+    info['size'] = len(_BASIS_CACHE)
+    info['graphs'] = len(_BASIS_CONSTANTS)
+    return info
+
+
+def clear_basis_cache():
+    """Empty the basis cache and reset its hit/miss counts"""
+    _BASIS_CACHE.clear()
+    _BASIS_CONSTANTS.clear()
+    for key in _BASIS_CACHE_STATS:
+        _BASIS_CACHE_STATS[key] = 0